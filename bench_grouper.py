@@ -0,0 +1,518 @@
+"""
+Load and scale benchmarks for grouper's JSON/REST API.
+
+Seeds a synthetic directory of users and groups with power-law group sizes,
+then measures throughput, p50/p99 latency and (in-process) SQL queries per
+request for every route, and writes the results as JSON.  For example:
+
+    $ python bench_grouper.py --dataset small
+    $ python bench_grouper.py --dataset medium --compare bench_output.json
+
+By default requests go through the Flask test client against a fresh
+temporary SQLite database.  With --url, they go over real sockets to a
+running server instead, and the dataset is added to whatever it serves.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+
+DATASETS = {
+    # name: (users, groups)
+    'small': (1000, 100),
+    'medium': (100000, 5000),
+    'large': (1000000, 20000),
+}
+
+# Seeding and membership batches, within the API's bulk limits
+BATCH_SIZE = 10000
+
+
+# Clients
+
+
+class InProcessClient(object):
+    """Send requests through the Flask test client, counting SQL queries."""
+
+    mode = 'in-process'
+
+    def __init__(self, app):
+        from sqlalchemy import event
+        from grouper import API_URL, db
+
+        self.api_url = API_URL
+        self.client = app.test_client()
+        self.queries = 0
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute',
+                         self._count_query)
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(self.api_url + path, method=method,
+                                    json=body, headers=headers)
+        return response.status_code, response.headers, response.get_data()
+
+
+class SocketClient(object):
+    """Send requests over HTTP to a running server."""
+
+    mode = 'socket'
+    queries = None
+
+    def __init__(self, url):
+        import requests
+        from grouper import API_URL
+
+        self.base = url.rstrip('/') + API_URL
+        self.session = requests.Session()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.session.request(method, self.base + path, json=body,
+                                        headers=headers)
+        return response.status_code, response.headers, response.content
+
+
+def call(client, method, path, body=None, expect=(200, 201)):
+    """Make an untimed request, returning its decoded JSON body."""
+    status, _, data = client.request(method, path, body)
+    if status not in expect:
+        sys.exit('{} {} failed with {}: {}'.format(method, path, status,
+                                                     data[:200]))
+    return json.loads(data.decode('utf-8')) if data else None
+
+
+# Seeding
+
+
+def group_sizes(n_users, n_groups, alpha, top_fraction=0.5):
+    """Return power-law (Zipf) group sizes, the largest first."""
+    return [max(1, min(n_users, int(n_users * top_fraction / k ** alpha)))
+            for k in range(1, n_groups + 1)]
+
+
+def seed(client, n_users, n_groups, alpha, rng):
+    """Create the synthetic dataset through the bulk API endpoints.
+
+    Returns the lists of user and group ids created.
+    """
+    tag = '{:08x}'.format(rng.getrandbits(32))
+    user_ids, group_ids = [], []
+    for start in range(0, n_users, BATCH_SIZE):
+        users = [{'name': 'bench-{}-user{}'.format(tag, i),
+                  'email': 'user{}@{}.example.com'.format(i, tag)}
+                 for i in range(start, min(n_users, start + BATCH_SIZE))]
+        results = call(client, 'POST', '/users/bulk', {'users': users})
+        user_ids.extend(r['id'] for r in results['users'])
+    for start in range(0, n_groups, BATCH_SIZE):
+        groups = [{'name': 'bench-{}-group{}'.format(tag, i)}
+                  for i in range(start, min(n_groups, start + BATCH_SIZE))]
+        results = call(client, 'POST', '/groups/bulk', {'groups': groups})
+        group_ids.extend(r['id'] for r in results['groups'])
+
+    for group_id, size in zip(group_ids,
+                              group_sizes(n_users, n_groups, alpha)):
+        members = sorted(rng.sample(user_ids, size))
+        for start in range(0, size, BATCH_SIZE):
+            call(client, 'POST', '/groups/{}/users'.format(group_id),
+                 {'users': members[start:start + BATCH_SIZE]})
+
+    # A shallow hierarchy, so that nested group routes have work to do
+    for parent, child in zip(group_ids[:10], group_ids[10:20]):
+        call(client, 'POST', '/groups/{}/subgroups/{}'.format(parent, child))
+    return user_ids, group_ids
+
+
+# Scenarios
+#
+# Each scenario prepares one request, making any untimed setup requests it
+# needs first, and returns (method, path, body, headers).  Reads come first,
+# since the write scenarios change the dataset.
+
+
+class Context(object):
+    """State shared by the scenarios."""
+
+    def __init__(self, client, user_ids, group_ids, rng):
+        self.client = client
+        self.user_ids = user_ids
+        self.group_ids = group_ids
+        self.rng = rng
+        self.counter = 0
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def group(self):
+        return self.rng.choice(self.group_ids)
+
+    def popular_group(self):
+        return self.rng.choice(self.group_ids[:10])
+
+    def change(self):
+        """Return a sequence number in the seeded part of the change log."""
+        return self.rng.randrange(len(self.user_ids) + len(self.group_ids))
+
+    def name(self, prefix):
+        self.counter += 1
+        return 'bench-{}-{}-{}'.format(prefix, os.getpid(), self.counter)
+
+    def new_user(self):
+        body = {'name': self.name('user'), 'email': 'new@example.com'}
+        return call(self.client, 'POST', '/users', body)['user']['id']
+
+    def new_group(self):
+        return call(self.client, 'POST', '/groups',
+                    {'name': self.name('group')})['group']['id']
+
+    def new_subgroup(self):
+        """Return a new (parent, child) pair of groups."""
+        parent, child = self.new_group(), self.new_group()
+        call(self.client, 'POST',
+             '/groups/{}/subgroups/{}'.format(parent, child))
+        return parent, child
+
+
+def etag_request(ctx, path):
+    """Prepare a conditional GET of `path`, with its current ETag."""
+    _, headers, _ = ctx.client.request('GET', path)
+    return ('GET', path, None, {'If-None-Match': headers.get('ETag', '')})
+
+
+def remove_subgroups(ctx):
+    """Prepare removing a new subgroup through the batch route."""
+    parent, child = ctx.new_subgroup()
+    return ('DELETE', '/groups/{}/subgroups'.format(parent),
+            {'groups': [child]}, None)
+
+
+SCENARIOS = [
+    ('list_users', lambda ctx: ('GET', '/users', None, None)),
+    ('list_users_deep', lambda ctx: (
+        'GET', '/users?after={}'.format(ctx.user()), None, None)),
+    ('list_users_sparse', lambda ctx: (
+        'GET', '/users?fields=id,name&limit=1000', None, None)),
+    ('list_users_fast', lambda ctx: (
+        'GET', '/users?fast=1&limit=1000', None, None)),
+    ('list_groups', lambda ctx: ('GET', '/groups', None, None)),
+    ('get_user', lambda ctx: ('GET', '/users/{}'.format(ctx.user()),
+                              None, None)),
+    ('get_user_fast', lambda ctx: (
+        'GET', '/users/{}?fast=1'.format(ctx.user()), None, None)),
+    ('get_user_not_modified', lambda ctx: etag_request(
+        ctx, '/users/{}'.format(ctx.user()))),
+    ('get_group', lambda ctx: ('GET', '/groups/{}'.format(ctx.group()),
+                               None, None)),
+    ('get_popular_group', lambda ctx: (
+        'GET', '/groups/{}'.format(ctx.popular_group()), None, None)),
+    ('check_membership', lambda ctx: (
+        'GET', '/users/{}/groups/{}'.format(ctx.user(), ctx.popular_group()),
+        None, None)),
+    ('check_membership_by_group', lambda ctx: (
+        'GET', '/groups/{}/users/{}'.format(ctx.popular_group(), ctx.user()),
+        None, None)),
+    ('check_memberships_batch', lambda ctx: (
+        'POST', '/memberships/check',
+        {'pairs': [[ctx.user(), ctx.group()] for _ in range(100)]}, None)),
+    ('effective_groups', lambda ctx: (
+        'GET', '/users/{}/effective-groups'.format(ctx.user()), None, None)),
+    ('effective_users', lambda ctx: (
+        'GET', '/groups/{}/effective-users'.format(ctx.popular_group()),
+        None, None)),
+    ('get_subgroups', lambda ctx: (
+        'GET', '/groups/{}/subgroups'.format(ctx.popular_group()),
+        None, None)),
+    ('query_groups', lambda ctx: (
+        'POST', '/groups/query',
+        {'expr': {'minus': [{'and': [ctx.popular_group(),
+                                     ctx.popular_group()]},
+                            ctx.group()]}}, None)),
+    ('query_groups_count', lambda ctx: (
+        'POST', '/groups/query',
+        {'expr': {'or': [ctx.popular_group(), ctx.group()]}, 'count': True},
+        None)),
+    ('cache_stats', lambda ctx: ('GET', '/cache', None, None)),
+    ('get_changes', lambda ctx: (
+        'GET', '/changes?since={}&limit=1000'.format(ctx.change()),
+        None, None)),
+    ('add_user', lambda ctx: (
+        'POST', '/users', {'name': ctx.name('user'),
+                           'email': 'new@example.com',
+                           'groups': [ctx.group()]}, None)),
+    ('add_users_bulk', lambda ctx: (
+        'POST', '/users/bulk',
+        {'users': [{'name': ctx.name('user'), 'email': 'new@example.com'}
+                   for _ in range(100)]}, None)),
+    ('modify_user', lambda ctx: (
+        'PUT', '/users/{}'.format(ctx.user()),
+        {'email': 'changed@example.com'}, None)),
+    ('add_group', lambda ctx: (
+        'POST', '/groups', {'name': ctx.name('group')}, None)),
+    ('add_groups_bulk', lambda ctx: (
+        'POST', '/groups/bulk',
+        {'groups': [{'name': ctx.name('group')} for _ in range(100)]},
+        None)),
+    ('modify_group', lambda ctx: (
+        'PUT', '/groups/{}'.format(ctx.group()),
+        {'name': ctx.name('group')}, None)),
+    ('add_membership', lambda ctx: (
+        'POST', '/groups/{}/users/{}'.format(ctx.popular_group(), ctx.user()),
+        None, None)),
+    ('add_membership_by_user', lambda ctx: (
+        'POST', '/users/{}/groups/{}'.format(ctx.user(), ctx.group()),
+        None, None)),
+    ('add_memberships_batch', lambda ctx: (
+        'POST', '/users/{}/groups'.format(ctx.user()),
+        {'groups': [ctx.group() for _ in range(10)]}, None)),
+    ('add_memberships_batch_by_group', lambda ctx: (
+        'POST', '/groups/{}/users'.format(ctx.group()),
+        {'users': [ctx.user() for _ in range(100)]}, None)),
+    ('remove_membership', lambda ctx: (
+        'DELETE', '/users/{}/groups/{}'.format(ctx.user(),
+                                               ctx.popular_group()),
+        None, None)),
+    ('remove_membership_by_group', lambda ctx: (
+        'DELETE', '/groups/{}/users/{}'.format(ctx.popular_group(),
+                                               ctx.user()), None, None)),
+    ('remove_memberships_batch', lambda ctx: (
+        'DELETE', '/groups/{}/users'.format(ctx.popular_group()),
+        {'users': [ctx.user() for _ in range(10)]}, None)),
+    ('remove_memberships_batch_by_user', lambda ctx: (
+        'DELETE', '/users/{}/groups'.format(ctx.user()),
+        {'groups': [ctx.group() for _ in range(10)]}, None)),
+    ('add_subgroup', lambda ctx: (
+        'POST', '/groups/{}/subgroups/{}'.format(ctx.new_group(),
+                                                 ctx.group()), None, None)),
+    ('add_subgroups_batch', lambda ctx: (
+        'POST', '/groups/{}/subgroups'.format(ctx.new_group()),
+        {'groups': [ctx.group() for _ in range(10)]}, None)),
+    ('remove_subgroup', lambda ctx: (
+        'DELETE', '/groups/{}/subgroups/{}'.format(*ctx.new_subgroup()),
+        None, None)),
+    ('remove_subgroups_batch', lambda ctx: remove_subgroups(ctx)),
+    ('delete_user', lambda ctx: (
+        'DELETE', '/users/{}'.format(ctx.new_user()), None, None)),
+    ('delete_group', lambda ctx: (
+        'DELETE', '/groups/{}'.format(ctx.new_group()), None, None)),
+    ('stream_groups', lambda ctx: (
+        'GET', '/groups?stream=1', None, None)),
+]
+
+# Scenarios too slow to repeat many times on large datasets
+SLOW_SCENARIOS = {'stream_groups'}
+
+
+# Measurement
+
+
+def percentile(sorted_values, fraction):
+    """Return the nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_scenario(ctx, prepare, n_requests, warmup):
+    """Time `n_requests` requests prepared by `prepare`.
+
+    Returns the stats and the (method, path) of the last request made.
+    """
+    client = ctx.client
+    latencies, queries, statuses = [], [], {}
+    started = None
+    busy = 0.0
+    for i in range(warmup + n_requests):
+        method, path, body, headers = prepare(ctx)
+        before = client.queries
+        start = time.perf_counter()
+        status, _, _ = client.request(method, path, body, headers)
+        elapsed = time.perf_counter() - start
+        if i < warmup:
+            continue
+        if started is None:
+            started = start
+        busy += elapsed
+        latencies.append(elapsed)
+        if before is not None:
+            queries.append(client.queries - before)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    latencies.sort()
+    ms = 1000.0
+    return (method, path), {
+        'requests': n_requests,
+        'throughput_rps': n_requests / busy if busy else None,
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies) * ms,
+            'p50': percentile(latencies, 0.50) * ms,
+            'p99': percentile(latencies, 0.99) * ms,
+            'max': latencies[-1] * ms,
+        },
+        'queries_per_request': {
+            'mean': sum(queries) / len(queries),
+            'max': max(queries),
+        } if queries else None,
+        'statuses': statuses,
+    }
+
+
+def uncovered_routes(app, requests):
+    """Return the API routes that none of `requests` resolved to."""
+    from grouper import API_URL
+
+    adapter = app.url_map.bind('localhost')
+    seen = set()
+    for method, path in requests:
+        rule, _ = adapter.match(API_URL + path.split('?')[0],
+                                method=method, return_rule=True)
+        seen.add((method, rule.rule))
+    routes = set()
+    for rule in app.url_map.iter_rules():
+        if rule.rule.startswith(API_URL):
+            routes.update((method, rule.rule)
+                          for method in rule.methods - {'HEAD', 'OPTIONS'})
+    return sorted(routes - seen)
+
+
+def compare(results, baseline, threshold):
+    """Print changes against a previous run; return the regressed scenarios.
+
+    A scenario regresses if its p50 latency grows by more than `threshold`
+    or it makes more SQL queries per request than before.
+    """
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        before = baseline.get('results', {}).get(name)
+        if before is None:
+            continue
+        p50 = result['latency_ms']['p50'] / before['latency_ms']['p50']
+        p99 = result['latency_ms']['p99'] / before['latency_ms']['p99']
+        queries = result['queries_per_request']
+        queries_before = before['queries_per_request']
+        extra = 0
+        if queries and queries_before:
+            extra = queries['mean'] - queries_before['mean']
+        print('{:34} p50 x{:.2f}  p99 x{:.2f}  queries {:+.1f}'.format(
+              name, p50, p99, extra))
+        if p50 > 1 + threshold or extra > 0:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', choices=sorted(DATASETS),
+                        default='small', help='size of the synthetic dataset')
+    parser.add_argument('--users', type=int, help='override number of users')
+    parser.add_argument('--groups', type=int,
+                        help='override number of groups')
+    parser.add_argument('--alpha', type=float, default=1.0,
+                        help='power-law exponent of group sizes')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='untimed requests per scenario')
+    parser.add_argument('--only', action='append', metavar='SCENARIO',
+                        help='run only these scenarios')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, for reproducible runs')
+    parser.add_argument('--url',
+                        help='benchmark a running server over sockets')
+    parser.add_argument('--output', default='bench_output.json',
+                        help='where to write the JSON results')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='previous results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='p50 slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    n_users, n_groups = DATASETS[args.dataset]
+    n_users = args.users or n_users
+    n_groups = args.groups or n_groups
+    rng = random.Random(args.seed)
+
+    if args.url:
+        client = SocketClient(args.url)
+        app = None
+    else:
+        from grouper import create_app
+
+        tmpdir = tempfile.mkdtemp(prefix='grouper-bench-')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' +
+                          os.path.join(tmpdir, 'bench.sqlite')})
+        client = InProcessClient(app)
+
+    print('Seeding {} users and {} groups ({})...'.format(
+          n_users, n_groups, client.mode))
+    start = time.perf_counter()
+    user_ids, group_ids = seed(client, n_users, n_groups, args.alpha, rng)
+    seed_seconds = time.perf_counter() - start
+
+    ctx = Context(client, user_ids, group_ids, rng)
+    results = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'mode': client.mode,
+            'url': args.url,
+            'dataset': args.dataset,
+            'users': n_users,
+            'groups': n_groups,
+            'alpha': args.alpha,
+            'seed': args.seed,
+            'seed_seconds': seed_seconds,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': {},
+    }
+    requests = []
+    for name, prepare in SCENARIOS:
+        if args.only and name not in args.only:
+            continue
+        n_requests = args.requests
+        if name in SLOW_SCENARIOS and n_users > DATASETS['small'][0]:
+            n_requests = max(1, n_requests // 100)
+        last, result = run_scenario(ctx, prepare, n_requests,
+                                    min(args.warmup, n_requests))
+        requests.append(last)
+        results['results'][name] = result
+        queries = result['queries_per_request']
+        print('{:34} {:9.1f} req/s  p50 {:8.2f} ms  p99 {:8.2f} ms  {}'
+              .format(name, result['throughput_rps'],
+                      result['latency_ms']['p50'],
+                      result['latency_ms']['p99'],
+                      '' if queries is None else
+                      '{:.1f} queries'.format(queries['mean'])))
+
+    if app is not None and not args.only:
+        missing = uncovered_routes(app, requests)
+        if missing:
+            print('Routes without a scenario: {}'.format(missing))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Wrote {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print('Regressions: {}'.format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,11 +5,52 @@ It exposes a JSON/REST API and stores the user and group info in a database.
 See README.md for more details.
 """
 
+import csv
 import os
-from flask import Flask, request, jsonify, make_response
-from flask_sqlalchemy import SQLAlchemy
-from flask_script import Manager
+import queue
+import re
+import sys
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache, partial, wraps
+from itertools import cycle, islice
+from json.encoder import encode_basestring_ascii
+from flask import (Blueprint, Flask, current_app, request, jsonify,
+                   make_response, json, g, has_request_context,
+                   stream_with_context, copy_current_request_context)
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from flask_script import Command, Manager, Option
+from sqlalchemy import (and_, bindparam, column, create_engine, event,
+                        except_, exists, func, inspect, intersect, literal,
+                        or_, orm, select, table, union)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
 from marshmallow import Schema, fields, validate, ValidationError
+from werkzeug.local import LocalProxy
+from grouper_snapshot import write_snapshot
+
+# Optional encodings (see `negotiate_encoding`)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 # Config
@@ -20,31 +61,430 @@ API_URL = '/grouper/api/v1'
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 FALLBACK_DB = 'sqlite:///' + os.path.join(BASEDIR, 'data.sqlite')
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = (os.environ.get('DATABASE_URL') or
-                                         FALLBACK_DB)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
 
-db = SQLAlchemy(app)
-manager = Manager(app)
+
+def default_config():
+    """Return the default configuration, taken from the environment."""
+    env = os.environ.get
+    return {
+        'SQLALCHEMY_DATABASE_URI': env('DATABASE_URL') or FALLBACK_DB,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        # Entries in the in-process cache of serialized users and groups
+        # (0 = off)
+        'GROUPER_CACHE_SIZE': int(env('GROUPER_CACHE_SIZE') or 0),
+        # Log requests slower than this, with their SQL statements (0 = off)
+        'GROUPER_SLOW_REQUEST_MS': float(env('GROUPER_SLOW_REQUEST_MS') or 0),
+        # URIs of read replicas of the database, separated by whitespace
+        # or commas, for GETs of users and groups to be spread over
+        'GROUPER_READ_REPLICAS': env('GROUPER_READ_REPLICAS', '')
+                                 .replace(',', ' ').split(),
+        # Seconds after a write for which its client reads from the primary
+        'GROUPER_REPLICA_LAG': float(env('GROUPER_REPLICA_LAG') or 5),
+        # Compress responses of at least this many bytes (and all streams)
+        # for clients that accept it (0 = off)
+        'GROUPER_COMPRESS_MIN_SIZE': int(env('GROUPER_COMPRESS_MIN_SIZE')
+                                         or 1024),
+        # Milliseconds to wait for more writes to commit together with the
+        # first one (0 = off, every write commits on its own), and the most
+        # writes committed together (see `WriteBatcher`)
+        'GROUPER_BATCH_WINDOW_MS': float(env('GROUPER_BATCH_WINDOW_MS')
+                                         or 0),
+        'GROUPER_BATCH_SIZE': int(env('GROUPER_BATCH_SIZE') or 100),
+        # Serve reads through the fast path (see `fast_encoder`) unless a
+        # request asks otherwise with ?fast=0
+        'GROUPER_FAST_READS': env('GROUPER_FAST_READS', '0') != '0',
+        # Database connections kept open per process, and extra ones
+        # allowed under load (unused for in-memory SQLite)
+        'GROUPER_POOL_SIZE': int(env('GROUPER_POOL_SIZE') or 5),
+        'GROUPER_MAX_OVERFLOW': int(env('GROUPER_MAX_OVERFLOW') or 10),
+        # Test connections before use, to survive database restarts
+        'GROUPER_POOL_PRE_PING': env('GROUPER_POOL_PRE_PING', '1') != '0',
+        # Per-connection SQLite page cache (KiB) and memory-mapped I/O size
+        'GROUPER_SQLITE_CACHE_KB': int(env('GROUPER_SQLITE_CACHE_KB')
+                                       or 64 * 1024),
+        'GROUPER_SQLITE_MMAP_SIZE': int(env('GROUPER_SQLITE_MMAP_SIZE')
+                                        or 256 * 1024 * 1024),
+    }
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from a replica, if one was chosen for it.
+
+    See `route_to_replica`.  Anything that writes goes to the primary.
+
+    Between `begin_savepoint` and `end_savepoints` (see `WriteBatcher`),
+    `commit` and `rollback` only release or roll back the current savepoint,
+    and then begin the next one.
+    """
+
+    def begin_savepoint(self):
+        self.info['savepoint'] = self.begin_nested()
+        # What a rollback to the savepoint no longer needs invalidated
+        self.info['savepoint_touched'] = set(self.info.get('touched', ()))
+
+    def end_savepoints(self, release=True):
+        """Release the current savepoint (unless not `release`)."""
+        self.info.pop('savepoint_touched', None)
+        savepoint = self.info.pop('savepoint', None)
+        if release and savepoint is not None:
+            savepoint.commit()
+
+    def commit(self):
+        savepoint = self.info.get('savepoint')
+        if savepoint is None:
+            return super(RoutingSession, self).commit()
+        savepoint.commit()
+        self.begin_savepoint()
+
+    def rollback(self):
+        savepoint = self.info.get('savepoint')
+        if savepoint is None:
+            return super(RoutingSession, self).rollback()
+        savepoint.rollback()
+        self.info['touched'] = self.info['savepoint_touched']
+        self.begin_savepoint()
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get('replica')
+        if replica is not None and not (self.new or self.dirty or
+                                        self.deleted):
+            return replica
+        return super(RoutingSession, self).get_bind(mapper, clause, **kw)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+api = Blueprint('grouper', __name__)
 
 SQL_MAXINT = int(2**63 - 1)
 
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+MAX_BULK_SIZE = 10000
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+WRITE_COOKIE = 'grouper_write'
+
+# Most group ids allowed in one set expression (see `GroupQuerySchema`),
+# and most operators nested in one another
+MAX_QUERY_TERMS = 100
+MAX_QUERY_DEPTH = 10
+
+# Longest search string accepted (see `search_criteria`)
+MAX_SEARCH_LENGTH = 200
+
+# Keep IN (...) lists under SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+# Memberships deleted per transaction by background deletes
+DELETE_CHUNK_SIZE = 10000
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4'
+
+
+# Metrics
+
+
+# Histogram bucket upper bounds for durations (seconds) and query counts
+DURATION_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                    5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 1000)
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                              .replace('"', r'\"').replace('\n', r'\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(object):
+    """Prometheus counter, with one series per tuple of label values."""
+
+    def __init__(self, name, help_, labels):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, values, amount=1):
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            series = sorted(self.series.items())
+        for values, count in series:
+            lines.append('{}{} {}'.format(
+                    self.name, format_labels(self.labels, values), count))
+        return lines
+
+
+class Histogram(Counter):
+    """Prometheus histogram, with one series per tuple of label values.
+
+    Each series is a list of per-bucket counts (the last for +Inf) followed
+    by the sum of the observed values.
+    """
+
+    def __init__(self, name, help_, labels, buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, help_, labels)
+        self.buckets = buckets
+
+    def observe(self, values, value):
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [0] * (len(self.buckets) + 2)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            series = sorted((k, list(v)) for k, v in self.series.items())
+        for values, counts in series:
+            total = 0
+            bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                total += count
+                lines.append('{}_bucket{} {}'.format(
+                        self.name, format_labels(self.labels, values,
+                                                 'le="{}"'.format(bound)),
+                        total))
+            labels = format_labels(self.labels, values)
+            lines.append('{}_sum{} {!r}'.format(self.name, labels, counts[-1]))
+            lines.append('{}_count{} {}'.format(self.name, labels, total))
+        return lines
+
+
+ROUTE_LABELS = ('method', 'route')
+
+
+def make_metrics():
+    """Return a fresh set of metrics, keyed by name."""
+    return OrderedDict((m.name, m) for m in [
+        Counter('grouper_requests_total', 'Requests handled.',
+                ROUTE_LABELS + ('status',)),
+        Histogram('grouper_request_duration_seconds', 'Request latency.',
+                  ROUTE_LABELS),
+        Histogram('grouper_request_queries', 'SQL queries per request.',
+                  ROUTE_LABELS, QUERY_BUCKETS),
+        Histogram('grouper_db_duration_seconds',
+                  'Time per request spent executing SQL.', ROUTE_LABELS),
+        Histogram('grouper_serialize_duration_seconds',
+                  'Time per request spent serializing with marshmallow.',
+                  ROUTE_LABELS),
+        Histogram('grouper_deserialize_duration_seconds',
+                  'Time per request spent deserializing and validating with '
+                  'marshmallow (excluding SQL).', ROUTE_LABELS),
+        Histogram('grouper_json_duration_seconds',
+                  'Time per request spent encoding JSON.', ROUTE_LABELS),
+    ])
+
+
+# The metrics of the current app
+metrics = LocalProxy(lambda: current_app.extensions['grouper_metrics'])
+
+
+class RequestMetrics(object):
+    """Timings and SQL queries accumulated while handling one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.status = 500
+        self.queries = 0
+        self.statements = []
+        self.timings = dict.fromkeys(('db', 'serialize', 'deserialize',
+                                      'json'), 0.0)
+
+
+def current_metrics():
+    return g.get('metrics') if has_request_context() else None
+
+
+@contextmanager
+def timed(kind):
+    """Add the time spent in the block (less any SQL) to a request timing."""
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    db_before = metrics.timings['db']
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.timings[kind] += elapsed - (metrics.timings['db'] - db_before)
+
+
+class TimedSchema(Schema):
+    """Schema that records its (de)serialization time in the metrics."""
+
+    def dump(self, *args, **kwargs):
+        with timed('serialize'):
+            return super(TimedSchema, self).dump(*args, **kwargs)
+
+    def load(self, *args, **kwargs):
+        with timed('deserialize'):
+            return super(TimedSchema, self).load(*args, **kwargs)
+
+
+class TimedJSONEncoder(json.JSONEncoder):
+    """JSON encoder that records its encoding time in the metrics."""
+
+    def encode(self, o):
+        with timed('json'):
+            return super(TimedJSONEncoder, self).encode(o)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    context.grouper_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    metrics = current_metrics()
+    if metrics is None:
+        return
+    elapsed = time.perf_counter() - context.grouper_start
+    metrics.queries += 1
+    metrics.timings['db'] += elapsed
+    if current_app.config['GROUPER_SLOW_REQUEST_MS']:
+        metrics.statements.append((elapsed, statement))
+
+
+@api.before_app_request
+def start_request_metrics():
+    g.metrics = RequestMetrics()
+
+
+@api.after_app_request
+def record_status(response):
+    g.metrics.status = response.status_code
+    return response
+
+
+@api.after_app_request
+def remember_write(response):
+    """Note the time of a client's write, so it can read its own writes.
+
+    See `route_to_replica`.
+    """
+    if (current_app.extensions['grouper_replicas'] is not None and
+            request.method not in ('GET', 'HEAD', 'OPTIONS') and
+            response.status_code < 400):
+        lag = current_app.config['GROUPER_REPLICA_LAG']
+        response.set_cookie(WRITE_COOKIE, '{:.3f}'.format(time.time()),
+                            max_age=int(lag) + 1, httponly=True)
+    return response
+
+
+@api.teardown_app_request
+def record_request_metrics(error):
+    """Record a finished request's metrics, logging it if it was slow.
+
+    This runs once a streamed response has been fully sent.
+    """
+    request_metrics = g.pop('metrics', None)
+    if request_metrics is None:
+        return
+    duration = time.perf_counter() - request_metrics.start
+    rule = request.url_rule.rule if request.url_rule else '<unmatched>'
+    labels = (request.method, rule)
+    metrics['grouper_requests_total'].inc(
+            labels + (str(request_metrics.status),))
+    metrics['grouper_request_duration_seconds'].observe(labels, duration)
+    metrics['grouper_request_queries'].observe(labels,
+                                               request_metrics.queries)
+    for kind, elapsed in request_metrics.timings.items():
+        metrics['grouper_{}_duration_seconds'.format(kind)].observe(labels,
+                                                                    elapsed)
+
+    threshold = current_app.config['GROUPER_SLOW_REQUEST_MS']
+    if threshold and duration * 1000 > threshold:
+        current_app.logger.warning(
+                'Slow request: %s %s took %.1f ms (%d queries, %.1f ms in '
+                'SQL)%s', request.method, request.full_path.rstrip('?'),
+                duration * 1000, request_metrics.queries,
+                request_metrics.timings['db'] * 1000,
+                ''.join('\n  [%.1f ms] %s' % (elapsed * 1000, statement)
+                        for elapsed, statement in request_metrics.statements))
+
 
 # Database Models
 
 
 user_groups = db.Table('user_groups',
-        db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
-        db.Column('group_id', db.Integer, db.ForeignKey('groups.id')),
+        db.Column('user_id', db.Integer, db.ForeignKey('users.id'),
+                  primary_key=True),
+        db.Column('group_id', db.Integer, db.ForeignKey('groups.id'),
+                  primary_key=True, index=True),
+        )
+
+# Groups can contain groups; these are the direct parent -> child edges
+group_groups = db.Table('group_groups',
+        db.Column('parent_id', db.Integer, db.ForeignKey('groups.id'),
+                  primary_key=True),
+        db.Column('child_id', db.Integer, db.ForeignKey('groups.id'),
+                  primary_key=True, index=True),
+        )
+
+# Transitive closure of group_groups, kept up to date on every change: one
+# row per (ancestor, descendant) pair, including each group with itself,
+# with the number of distinct paths between them.
+group_closure = db.Table('group_closure',
+        db.Column('ancestor_id', db.Integer, db.ForeignKey('groups.id'),
+                  primary_key=True),
+        db.Column('descendant_id', db.Integer, db.ForeignKey('groups.id'),
+                  primary_key=True, index=True),
+        db.Column('paths', db.Integer, nullable=False, default=1),
+        )
+
+# Log of every change, in commit order (see `lock_change_log`), for
+# incremental sync (see `get_changes`).  `id` and `other_id` hold a user or
+# group id, or a membership's (user_id, group_id), or a subgroup's
+# (group_id, child_id).
+change_log = db.Table('change_log',
+        db.Column('seq', db.Integer, primary_key=True),
+        db.Column('kind', db.String(16), nullable=False),
+        db.Column('op', db.String(16), nullable=False),
+        db.Column('id', db.Integer),
+        db.Column('other_id', db.Integer),
+        db.Column('at', db.DateTime, nullable=False,
+                  server_default=func.current_timestamp()),
+        # Never reuse the seq of a deleted (compacted) entry
+        sqlite_autoincrement=True,
         )
 
 
 class User(db.Model):
     __tablename__ = 'users'
+    # Never reuse the id of a deleted user, whose ETags clients may still hold
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, nullable=False)
-    email = db.Column(db.String, nullable=False)
+    name = db.Column(db.String, nullable=False, unique=True, index=True)
+    email = db.Column(db.String, nullable=False, index=True)
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    # Number of groups the user is directly in (see `update_counts`)
+    group_count = db.Column(db.Integer, nullable=False, default=0,
+                            server_default='0')
     groups = db.relationship('Group',
                              secondary=user_groups,
                              backref=db.backref('users', lazy='dynamic'),
@@ -59,8 +499,14 @@ class User(db.Model):
 
 class Group(db.Model):
     __tablename__ = 'groups'
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, nullable=False)
+    name = db.Column(db.String, nullable=False, unique=True, index=True)
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    # Number of users directly in the group (see `update_counts`)
+    member_count = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
 
     def __repr__(self):
         rep = "Group(id={id!r}, name={name!r}, users={users!r})"
@@ -68,6 +514,52 @@ class Group(db.Model):
                           users=[u.id for u in self.users])
 
 
+# Full-text index of group names, on SQLite builds with FTS5.  It only stores
+# the index, reading names from the groups table, and triggers keep it in
+# sync with every write, including bulk imports.
+groups_fts = table('groups_fts', column('rowid'), column('name'))
+
+GROUP_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE groups_fts USING fts5("
+    "name, content='groups', content_rowid='id')",
+    "CREATE TRIGGER groups_fts_insert AFTER INSERT ON groups BEGIN "
+    "INSERT INTO groups_fts (rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER groups_fts_delete AFTER DELETE ON groups BEGIN "
+    "INSERT INTO groups_fts (groups_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER groups_fts_update AFTER UPDATE OF name ON groups BEGIN "
+    "INSERT INTO groups_fts (groups_fts, rowid, name) "
+    "VALUES ('delete', old.id, old.name); "
+    "INSERT INTO groups_fts (rowid, name) VALUES (new.id, new.name); END",
+]
+
+
+def has_fts5(conn):
+    """Return whether `conn` is to a SQLite database with FTS5."""
+    if conn.dialect.name != 'sqlite':
+        return False
+    options = {option for option, in conn.execute('PRAGMA compile_options')}
+    return 'ENABLE_FTS5' in options
+
+
+def create_group_search(conn):
+    """Create and fill the group name index, if supported and missing.
+
+    Returns True if it was created.
+    """
+    if not has_fts5(conn) or conn.dialect.has_table(conn, 'groups_fts'):
+        return False
+    for statement in GROUP_SEARCH_DDL:
+        conn.execute(statement)
+    conn.execute("INSERT INTO groups_fts (groups_fts) VALUES ('rebuild')")
+    return True
+
+
+@event.listens_for(Group.__table__, 'after_create')
+def groups_created(target, conn, **kw):
+    create_group_search(conn)
+
+
 # Marshmallow schemas for (de)serialization and validation
 
 
@@ -83,106 +575,1817 @@ def validate_id(id_):
         raise ValidationError('ID does not exist.')
 
 
+def deserialize_ids(model, value, message):
+    """Validate a list of `model` ids, returning the distinct ids.
+
+    Existence is checked with one batched query, without loading any rows.
+    """
+    if (not isinstance(value, list) or
+            not all(isinstance(id_, int) for id_ in value)):
+        raise ValidationError('Not a valid list of ids.')
+    ids = sorted(set(value))
+    if not all(1 <= id_ <= SQL_MAXINT for id_ in ids):
+        raise ValidationError(message)
+    if len(existing_ids(model, ids)) != len(ids):
+        raise ValidationError(message)
+    return ids
+
+
+class SharedSchema(TimedSchema):
+    """Schema whose context is local to each thread.
+
+    This lets one instance be shared between concurrent requests, each
+    setting its own context for the duration of a dump (see `dump_shared`).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        super(SharedSchema, self).__init__(*args, **kwargs)
+
+    @property
+    def context(self):
+        return getattr(self._local, 'context', {})
+
+    @context.setter
+    def context(self, value):
+        self._local.context = value
+
+
 class UserGroups(fields.Field):
-    """(De)serialization for a user's groups."""
+    """(De)serialization for a user's groups.
+
+    Serializes from the ``groups`` membership map in the schema context when
+    one was preloaded (see `dump_users`), and from the relationship otherwise.
+    """
 
     def _serialize(self, value, attr, obj):
+        preloaded = self.context.get('groups')
+        if preloaded is not None:
+            return preloaded.get(obj.id, [])
         return [v.id for v in value]
 
     def _deserialize(self, value, attr, obj):
-        if len(value) > 0:
-            result = Group.query.filter(Group.id.in_(value)).all()
-            if len(result) != len(value):
-                raise ValidationError('Not all supplied groups exist')
-            return result
-        else:
-            return []
+        return deserialize_ids(Group, value, 'Not all supplied groups exist')
 
 
-class UserSchema(Schema):
+class UserSchema(SharedSchema):
     """Schema to validate and (de)serialize Users."""
     id = fields.Int(dump_only=True, validate=validate_id)
     name = fields.Str(required=True, validate=must_not_be_blank)
     email = fields.Email(required=True)
     groups = UserGroups()
+    group_count = fields.Int(dump_only=True)
+
+    # Fields only dumped when asked for with ?fields=, and their aliases
+    extra_fields = ('group_count',)
+    field_aliases = {'count': 'group_count'}
 
 
 class GroupUsers(fields.Field):
-    """(De)serialization for a group's users."""
+    """(De)serialization for a group's users.
+
+    Serializes from the ``users`` membership map in the schema context when
+    one was preloaded (see `dump_groups`), and from the relationship otherwise.
+    """
     def _serialize(self, value, attr, obj):
+        preloaded = self.context.get('users')
+        if preloaded is not None:
+            return preloaded.get(obj.id, [])
         return [v.id for v in value]
 
     def _deserialize(self, value, attr, obj):
-        if len(value) > 0:
-            result = User.query.filter(User.id.in_(value)).all()
-            if len(result) != len(value):
-                raise ValidationError('Not all supplied users exist')
-            return result
-        else:
-            return []
+        return deserialize_ids(User, value, 'Not all supplied users exist')
 
 
-class GroupSchema(Schema):
+class GroupSchema(SharedSchema):
     """Schema to validate and (de)serialize Groups."""
     id = fields.Int(dump_only=True,
                     validate=validate.Range(min=1, max=SQL_MAXINT))
     name = fields.Str(required=True, validate=must_not_be_blank)
     users = GroupUsers()
+    member_count = fields.Int(dump_only=True)
+
+    extra_fields = ('member_count',)
+    field_aliases = {'count': 'member_count'}
+
+
+class UserBulkSchema(UserSchema):
+    """Schema to validate Users in bulk, leaving their groups as ids."""
+    groups = fields.List(fields.Int(validate=validate_id))
+
+
+class GroupBulkSchema(GroupSchema):
+    """Schema to validate Groups in bulk, leaving their users as ids."""
+    users = fields.List(fields.Int(validate=validate_id))
+
+
+class MembershipSchema(TimedSchema):
+    """Schema to validate the ids in a batch membership change."""
+    users = GroupUsers()
+    groups = UserGroups()
+
+
+def validate_pair(pair):
+    """Raise validation error if pair isn't a [user_id, group_id] pair."""
+    if len(pair) != 2:
+        raise ValidationError('Not a [user_id, group_id] pair.')
+
+
+class MembershipCheckSchema(TimedSchema):
+    """Schema to validate a batch of membership checks."""
+    pairs = fields.List(fields.List(fields.Int(validate=validate_id),
+                                    validate=validate_pair),
+                        required=True,
+                        validate=validate.Length(max=MAX_BULK_SIZE))
+
+
+class ReadSchema(TimedSchema):
+    """Schema to validate query arguments common to read endpoints."""
+    fast = fields.Bool()
+    primary = fields.Bool()
+
+
+class PageSchema(ReadSchema):
+    """Schema to validate keyset pagination query arguments."""
+    limit = fields.Int(validate=validate.Range(min=1, max=MAX_PAGE_SIZE))
+    after = fields.Int(validate=validate.Range(min=0, max=SQL_MAXINT))
+    stream = fields.Bool()
+
+
+class UserPageSchema(PageSchema):
+    """Schema to validate query arguments for listing and searching users."""
+    name_prefix = fields.Str(
+            validate=validate.Length(min=1, max=MAX_SEARCH_LENGTH))
+    email = fields.Str(validate=validate.Length(min=1, max=MAX_SEARCH_LENGTH))
+
+
+class GroupPageSchema(PageSchema):
+    """Schema to validate query arguments for listing and searching groups."""
+    name_prefix = fields.Str(
+            validate=validate.Length(min=1, max=MAX_SEARCH_LENGTH))
+    q = fields.Str(validate=validate.Length(min=1, max=MAX_SEARCH_LENGTH))
+
+
+SET_OPERATORS = ('and', 'or', 'minus')
+
+
+def expr_groups(expr, depth=0):
+    """Return the group ids in a set expression, validating its structure.
+
+    An expression is a group id, or an object with a single operator key
+    ('and', 'or' or 'minus') mapping to a non-empty list of expressions,
+    nested at most `MAX_QUERY_DEPTH` deep.  `depth` is that of `expr`.
+    """
+    if isinstance(expr, int) and not isinstance(expr, bool):
+        validate_id(expr)
+        return [expr]
+    if not isinstance(expr, dict) or len(expr) != 1:
+        raise ValidationError('Not a valid set expression.')
+    (op, args), = expr.items()
+    if op not in SET_OPERATORS:
+        raise ValidationError('Unknown set operator: {}.'.format(op))
+    if not isinstance(args, list) or not args:
+        raise ValidationError('Operator {} needs a list of operands.'
+                              .format(op))
+    if depth == MAX_QUERY_DEPTH:
+        raise ValidationError('Set expression is nested too deeply.')
+    return [id_ for arg in args for id_ in expr_groups(arg, depth + 1)]
+
+
+def validate_expr(expr):
+    """Raise validation error if expr isn't a valid set expression."""
+    ids = expr_groups(expr)
+    if len(ids) > MAX_QUERY_TERMS:
+        raise ValidationError('Too many groups in expression.')
+    if len(existing_ids(Group, ids)) != len(set(ids)):
+        raise ValidationError('Not all supplied groups exist')
+
+
+class GroupQuerySchema(PageSchema):
+    """Schema to validate set expressions over group membership."""
+    expr = fields.Raw(required=True, validate=validate_expr)
+    effective = fields.Bool()
+    count = fields.Bool()
+
+
+class MembershipArgsSchema(TimedSchema):
+    """Schema to validate query arguments for checking one membership."""
+    effective = fields.Bool()
+
+
+class DeleteSchema(TimedSchema):
+    """Schema to validate query arguments for deleting users and groups."""
+    background = fields.Bool()
+
+
+class ChangesSchema(TimedSchema):
+    """Schema to validate change feed query arguments."""
+    since = fields.Int(validate=validate.Range(min=0, max=SQL_MAXINT))
+    limit = fields.Int(validate=validate.Range(min=1, max=MAX_PAGE_SIZE))
 
 
 user_schema = UserSchema()
-users_schema = UserSchema(many=True)
 group_schema = GroupSchema()
-groups_schema = GroupSchema(many=True)
+membership_schema = MembershipSchema()
+membership_check_schema = MembershipCheckSchema()
+membership_args_schema = MembershipArgsSchema()
+user_bulk_schema = UserBulkSchema(many=True)
+group_bulk_schema = GroupBulkSchema(many=True)
+read_schema = ReadSchema()
+page_schema = PageSchema()
+user_page_schema = UserPageSchema()
+group_page_schema = GroupPageSchema()
+group_query_schema = GroupQuerySchema()
+changes_schema = ChangesSchema()
+delete_schema = DeleteSchema()
+
+
+@lru_cache(maxsize=None)
+def list_schema(schema_class, only=None):
+    """Return a shared many=True `schema_class` limited to the `only` fields.
+
+    Instances are built once per distinct field set and then reused.
+    """
+    return schema_class(many=True, only=only or default_fields(schema_class))
+
+
+def default_fields(schema_class):
+    """Return the sorted names of the fields dumped by default.
+
+    That is all of them but the schema's `extra_fields`.
+    """
+    return tuple(sorted(set(schema_class._declared_fields) -
+                        set(getattr(schema_class, 'extra_fields', ()))))
+
+
+# Caching
+
+
+class LocalCache(object):
+    """LRU cache backend holding at most `size` entries in this process.
+
+    Any object with the same `get`, `set` and `delete_many` methods can be
+    used as a backend instead, e.g. a thin wrapper around a cache shared by
+    all worker processes.  A local cache is only safe with a single worker,
+    since writes only invalidate the cache of the process handling them.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class SerializedCache(object):
+    """Read-through cache of serialized users and groups.
+
+    Entries are keyed by (table name, id) and hold (version, JSON text).
+    Write paths invalidate entries through `touch`, once their transaction
+    commits.  With no backend, every lookup is a miss and nothing is stored.
+
+    A value read from the database just before its entry is invalidated is
+    stale, so `set` takes the `generation` from before the read and drops
+    the value if its key has been invalidated since.  Only invalidations in
+    this process are seen.
+    """
+
+    # Invalidated keys remembered for `set`; if more are invalidated while
+    # a value is being read, it isn't stored
+    MAX_INVALIDATIONS = 10000
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = None if self.backend is None else self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, generation):
+        """Store `value`, read at `generation`, unless it may be stale."""
+        if self.backend is None:
+            return
+        with self._lock:
+            if (self._forgotten > generation or
+                    self._invalidated.get(key, 0) > generation):
+                return
+            self.backend.set(key, value)
+
+    def delete_many(self, keys):
+        if self.backend is None:
+            return
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._invalidated.pop(key, None)
+                self._invalidated[key] = self.generation
+            while len(self._invalidated) > self.MAX_INVALIDATIONS:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+            self.backend.delete_many(keys)
+
+    def stats(self):
+        stats = {'enabled': self.backend is not None,
+                 'hits': self.hits,
+                 'misses': self.misses}
+        if isinstance(self.backend, LocalCache):
+            stats.update(entries=len(self.backend), size=self.backend.size)
+        return stats
+
+
+# The cache of the current app
+cache = LocalProxy(lambda: current_app.extensions['grouper_cache'])
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def invalidate_touched(session):
+    """Drop the cache entries of everything touched by the transaction.
+
+    Writes in a batch (see `WriteBatcher`) only commit to a savepoint, and
+    keep their entries until the whole batch commits.
+    """
+    if 'savepoint' in session.info:
+        return
+    keys = session.info.pop('touched', None)
+    if keys:
+        cache.delete_many(keys)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def forget_touched(session):
+    # Rolling back to a savepoint forgets what it touched by itself
+    if 'savepoint' not in session.info:
+        session.info.pop('touched', None)
+
+
+# Database queries
+
+
+def after_cursor(model, args, criteria=()):
+    """Return the criterion for `model` rows after a page's cursor.
+
+    If there are search `criteria`, the id is wrapped in an expression, or
+    the database would walk the primary key from the cursor and filter every
+    row instead of scanning the search's index and sorting the few matches.
+    """
+    after = args.get('after', 0)
+    return (model.id + 0 if criteria else model.id) > after
+
+
+def paginate(model, args, criteria=()):
+    """Return a page of `model` rows ordered by id, and the next cursor.
+
+    Pages are selected by keyset (``id > after``) rather than OFFSET, so every
+    page costs one indexed range scan no matter how deep the client goes.  The
+    cursor is the last id on the page, or None if this is the last page.  Only
+    rows matching all of `criteria` (see `search_criteria`) are included.
+    """
+    limit = args.get('limit', PAGE_SIZE)
+    rows = (model.query.filter(after_cursor(model, args, criteria), *criteria)
+                       .order_by(model.id)
+                       .limit(limit + 1)
+                       .all())
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1].id
+    return rows, None
+
+
+def prefix_range(column, prefix):
+    """Return criteria selecting the `column` values starting with `prefix`.
+
+    They bound a range of the column's index in binary collation order: from
+    the prefix up to the prefix with its last character incremented.
+    """
+    criteria = [column >= prefix]
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if stem:
+        last = ord(stem[-1]) + 1
+        if 0xd800 <= last <= 0xdfff:
+            last = 0xe000  # surrogates can't be encoded
+        criteria.append(column < stem[:-1] + chr(last))
+    return criteria
+
+
+def search_criteria(model, args):
+    """Return SQL criteria selecting the `model` rows a request searches for.
+
+    `args` are the request's deserialized query arguments, of which
+    `name_prefix` is answered by a range scan of the name index and `email`
+    by a lookup in its index.  With `q`, every word in it must begin a word
+    of a group's name; that is looked up in the full-text index where there
+    is one, and otherwise by `word_prefix`, which scans the table.
+    """
+    criteria = []
+    if 'name_prefix' in args:
+        criteria.extend(prefix_range(model.name, args['name_prefix']))
+    if 'email' in args:
+        criteria.append(model.email == args['email'])
+    if 'q' in args:
+        words = re.findall(r'\w+', args['q'])
+        if words and current_app.extensions['grouper_group_search']:
+            match = ' '.join('"{}"*'.format(word) for word in words)
+            criteria.append(model.id.in_(
+                    select([groups_fts.c.rowid])
+                    .where(groups_fts.c.name.match(match))))
+        elif words:
+            criteria.extend(word_prefix(model.name, word) for word in words)
+        else:
+            criteria.append(model.name.ilike('%' + escape_like(args['q']) +
+                                             '%', escape='\\'))
+    return criteria
+
+
+# What separates the words of a name, where there's no full-text index
+WORD_SEPARATORS = ' -_./'
+
+
+def escape_like(s):
+    """Escape the wildcards of a LIKE pattern in `s`, with backslashes."""
+    return re.sub(r'([\\%_])', r'\\\1', s)
+
+
+def word_prefix(col, word):
+    """Return SQL matching `col` values with a word that begins with `word`.
+
+    Case is ignored, and words are split at `WORD_SEPARATORS`.  No index can
+    answer this, so it scans the table.
+    """
+    pattern = escape_like(word) + '%'
+    return or_(col.ilike(pattern, escape='\\'),
+               *(col.ilike('%' + escape_like(sep) + pattern, escape='\\')
+                 for sep in WORD_SEPARATORS))
+
+
+def chunks(seq, size=CHUNK_SIZE):
+    """Yield successive slices of `seq` of at most `size` items."""
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def load_memberships(owner, ids):
+    """Map each id in `ids` to the sorted ids it is associated with.
+
+    `owner` names the `user_groups` column that `ids` refer to ('user_id' or
+    'group_id').  Memberships for all the ids are read from the association
+    table in one query per `CHUNK_SIZE` ids, instead of one query per owner.
+    """
+    owner_col = user_groups.c[owner]
+    other_col = user_groups.c['group_id' if owner == 'user_id' else 'user_id']
+    result = {id_: [] for id_ in ids}
+    for chunk in chunks(list(result)):
+        rows = (db.session.query(owner_col, other_col)
+                          .filter(owner_col.in_(chunk))
+                          .order_by(owner_col, other_col))
+        for owner_id, other_id in rows:
+            result[owner_id].append(other_id)
+    return result
+
+
+def dump_shared(schema, objs, context):
+    """Dump `objs` with a shared schema, using `context` for this dump only."""
+    schema.context = context
+    try:
+        return schema.dump(objs).data
+    finally:
+        schema.context = {}
+
+
+def dump_users(users, only=None):
+    """Serialize a list of Users with a fixed number of queries.
+
+    If `only` is given, just those fields are included, and memberships are
+    only loaded if 'groups' is one of them.
+    """
+    schema = list_schema(UserSchema, only)
+    context = {}
+    if 'groups' in schema.fields:
+        context['groups'] = load_memberships('user_id', [u.id for u in users])
+    return dump_shared(schema, users, context)
+
+
+def dump_groups(groups, only=None):
+    """Serialize a list of Groups with a fixed number of queries.
+
+    If `only` is given, just those fields are included, and memberships are
+    only loaded if 'users' is one of them.
+    """
+    schema = list_schema(GroupSchema, only)
+    context = {}
+    if 'users' in schema.fields:
+        context['users'] = load_memberships('group_id', [g.id for g in groups])
+    return dump_shared(schema, groups, context)
+
+
+def encode_json_int(value):
+    return 'null' if value is None else str(int(value))
+
+
+def encode_json_str(value):
+    return 'null' if value is None else encode_basestring_ascii(value)
+
+
+@lru_cache(maxsize=None)
+def fast_encoder(model, only=None):
+    """Return (columns, encode) to serialize Users or Groups from Core rows.
+
+    `columns` are the table columns to select, id first.  `encode(row, ids)`
+    returns the JSON text of one such row, given the sorted ids of its
+    groups or users, byte for byte the same as `json.dumps` makes of its
+    schema dump with sorted keys, ASCII output and compact separators.  The
+    format is worked out once per distinct `only` field set, so encoding a
+    row is a single string interpolation.
+    """
+    schema_class = UserSchema if model is User else GroupSchema
+    members = 'groups' if model is User else 'users'
+    table = model.__table__
+    names = sorted(only or default_fields(schema_class))
+    columns = [table.c.id] + [table.c[name] for name in names
+                              if name not in ('id', members)]
+    index = {column.name: i for i, column in enumerate(columns)}
+
+    parts, getters = [], []
+    for name in names:
+        if name == members:
+            parts.append('"{}":[%s]'.format(name))
+            getters.append(lambda row, ids: ','.join(map(str, ids)))
+            continue
+        parts.append('"{}":%s'.format(name))
+        encode_value = (encode_json_int
+                        if isinstance(table.c[name].type, db.Integer)
+                        else encode_json_str)
+        getters.append(lambda row, ids, i=index[name], f=encode_value:
+                       f(row[i]))
+    template = '{' + ','.join(parts) + '}'
+
+    def encode(row, ids):
+        return template % tuple([get(row, ids) for get in getters])
+    return columns, encode
+
+
+def fast_dump(model, rows, only=None):
+    """Return the JSON texts of rows selected with `fast_encoder` columns.
+
+    The fast counterpart of `dump_users` and `dump_groups`.
+    """
+    _, encode = fast_encoder(model, only)
+    members = 'groups' if model is User else 'users'
+    if only is not None and members not in only:
+        ids = {}
+    else:
+        owner = 'user_id' if model is User else 'group_id'
+        ids = load_memberships(owner, [row[0] for row in rows])
+    with timed('serialize'):
+        return [encode(row, ids.get(row[0], ())) for row in rows]
+
+
+def fast_paginate(model, args, only=None, criteria=()):
+    """Return the JSON texts of a page of `model` rows, and the next cursor.
+
+    The fast counterpart of `paginate` followed by a dump.
+    """
+    columns, _ = fast_encoder(model, only)
+    limit = args.get('limit', PAGE_SIZE)
+    after = after_cursor(model, args, criteria)
+    rows = db.session.execute(select(columns)
+                              .where(and_(after, *criteria))
+                              .order_by(model.id)
+                              .limit(limit + 1)).fetchall()
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = rows[-1][0]
+    return fast_dump(model, rows, only), cursor
+
+
+def serialize(model, id_, only=None, fast=False):
+    """Return (version, JSON text) for one User or Group, or None.
+
+    The full serialization is read through the cache, so a hit costs no
+    queries at all; sparse ones (see `dump_users`) bypass it.  If `fast` is
+    true, it is made with `fast_encoder` instead of the schema.  What is read
+    from a replica isn't cached, as it may be behind the primary.
+    """
+    key = (model.__tablename__, id_)
+    if only is None:
+        value = cache.get(key)
+        if value is not None:
+            return value
+    generation = cache.generation
+
+    if fast:
+        columns, _ = fast_encoder(model, only)
+        row = db.session.execute(select(columns + [model.version])
+                                 .where(model.id == id_)).first()
+        if row is None:
+            return None
+        value = (row[-1], fast_dump(model, [row], only)[0])
+    else:
+        obj = model.query.get(id_)
+        if obj is None:
+            return None
+        dump = dump_users if model is User else dump_groups
+        value = (obj.version,
+                 json.dumps(dump([obj], only)[0], separators=(',', ':')))
+    if only is None and 'replica' not in db.session.info:
+        cache.set(key, value, generation)
+    return value
+
+
+def existing_ids(model, ids):
+    """Return the subset of `ids` that are ids of `model` rows."""
+    # One statement with an expanding IN, so that it isn't rebuilt and
+    # recompiled from scratch for every chunk
+    stmt = select([model.id]).where(
+            model.id.in_(bindparam('ids', expanding=True)))
+    found = set()
+    for chunk in chunks(sorted(ids)):
+        found.update(id_ for id_, in db.session.execute(stmt, {'ids': chunk}))
+    return found
+
+
+def existing_names(model, names):
+    """Map each of `names` that is already taken in `model` to its id."""
+    found = {}
+    for chunk in chunks(sorted(names)):
+        found.update(db.session.query(model.name, model.id)
+                               .filter(model.name.in_(chunk)))
+    return found
+
+
+def touch(user_ids=(), group_ids=()):
+    """Record that the given users and groups changed.
+
+    Bumps their version counters, which are used as ETags, in the current
+    transaction, and invalidates their cache entries when it commits.  Every
+    write path, including membership changes on either side, must call this
+    for everything whose serialization changed.
+    """
+    touched = db.session.info.setdefault('touched', set())
+    for model, ids in ((User, user_ids), (Group, group_ids)):
+        touched.update((model.__tablename__, id_) for id_ in ids)
+        for chunk in chunks(sorted(set(ids))):
+            db.session.execute(model.__table__.update()
+                                    .where(model.id.in_(chunk))
+                                    .values(version=model.version + 1))
+
+
+def lock_change_log(conn=None):
+    """Keep other transactions from logging changes until this one ends.
+
+    Sequence numbers are assigned when entries are inserted, so without
+    this, a transaction could commit entry N after a client following the
+    log had read N + 1, and the client would never see N.  SQLite runs one
+    write transaction at a time anyway; on PostgreSQL, this makes writers
+    wait for each other from their first logged change until they commit
+    (and `add_subgroups` relies on that, taking it early).  `conn` defaults
+    to the session.
+    """
+    conn = conn or db.session
+    bind = conn if isinstance(conn, Connection) else conn.get_bind()
+    if bind.dialect.name == 'postgresql':
+        conn.execute('LOCK TABLE change_log IN EXCLUSIVE MODE')
+
+
+def log_changes(kind, op, ids):
+    """Append changes to the change log, in the current transaction.
+
+    `kind` is 'user' or 'group', with one id in `ids` per changed user or
+    group, or 'membership' or 'subgroup', with one pair of ids per change.
+    """
+    rows = [{'kind': kind, 'op': op, 'id': id_, 'other_id': None}
+            if kind in ('user', 'group') else
+            {'kind': kind, 'op': op, 'id': id_[0], 'other_id': id_[1]}
+            for id_ in ids]
+    if rows:
+        lock_change_log()
+        db.session.execute(change_log.insert(), rows)
+
+
+def existing_memberships(pairs):
+    """Return the subset of (user_id, group_id) `pairs` in `user_groups`."""
+    pairs = set(pairs)
+    user_ids = sorted({u for u, _ in pairs})
+    group_ids = sorted({g for _, g in pairs})
+    found = set()
+    for user_chunk in chunks(user_ids):
+        for group_chunk in chunks(group_ids):
+            rows = (db.session.query(user_groups.c.user_id,
+                                     user_groups.c.group_id)
+                              .filter(user_groups.c.user_id.in_(user_chunk),
+                                      user_groups.c.group_id.in_(group_chunk)))
+            found.update(pair for pair in rows if pair in pairs)
+    return found
+
+
+def is_member(user_id, group_id):
+    """Return whether the user is in the group, with one primary key lookup."""
+    return db.session.query(exists().where(
+            (user_groups.c.user_id == user_id) &
+            (user_groups.c.group_id == group_id))).scalar()
+
+
+def is_effective_member(user_id, group_id):
+    """Return whether the user is in the group, directly or through nesting.
+
+    This is one indexed join against the closure table.
+    """
+    c = group_closure.c
+    return db.session.query(exists().where(
+            (c.ancestor_id == group_id) &
+            (user_groups.c.group_id == c.descendant_id) &
+            (user_groups.c.user_id == user_id))).scalar()
+
+
+def update_counts(added=(), removed=()):
+    """Adjust the denormalized membership counts, in the current transaction.
+
+    `added` and `removed` are the (user_id, group_id) pairs actually inserted
+    into and deleted from `user_groups`.  Every write path that changes
+    memberships must call this, or `recount` what it changed.
+    """
+    deltas = {User: defaultdict(int), Group: defaultdict(int)}
+    for pairs, sign in ((added, 1), (removed, -1)):
+        for user_id, group_id in pairs:
+            deltas[User][user_id] += sign
+            deltas[Group][group_id] += sign
+    for model, name in ((User, 'group_count'), (Group, 'member_count')):
+        rows = [{'_id': id_, '_delta': delta}
+                for id_, delta in sorted(deltas[model].items()) if delta]
+        if rows:
+            table = model.__table__
+            db.session.execute(table.update()
+                                    .where(table.c.id == bindparam('_id'))
+                                    .values({name: table.c[name] +
+                                             bindparam('_delta')}), rows)
+
+
+def recount(conn, user_ids=None, group_ids=None):
+    """Recompute the membership counts of users and groups, on `conn`.
+
+    Every user and group is recounted, unless limited to `user_ids` and
+    `group_ids`.  Each count is one indexed count of `user_groups` rows.
+    Only rows whose count was wrong are written, with their version bumped
+    and an update in the change log.  Returns the number of rows fixed.
+    """
+    fixed = 0
+    for model, name, key, ids in ((User, 'group_count', 'user_id', user_ids),
+                                  (Group, 'member_count', 'group_id',
+                                   group_ids)):
+        table = model.__table__
+        actual = (select([func.count()])
+                  .where(user_groups.c[key] == table.c.id)
+                  .as_scalar())
+        wrong = table.c[name] != actual
+        lock_change_log(conn)
+        for chunk in ([None] if ids is None else chunks(sorted(ids))):
+            where = wrong if chunk is None else wrong & table.c.id.in_(chunk)
+            conn.execute(change_log.insert().from_select(
+                    ['kind', 'op', 'id'],
+                    select([literal(model.__name__.lower()),
+                            literal('update'), table.c.id]).where(where)))
+            result = conn.execute(table.update().where(where).values(
+                    {name: actual, 'version': table.c.version + 1}))
+            fixed += result.rowcount
+    return fixed
+
+
+def add_memberships(pairs):
+    """Insert the (user_id, group_id) `pairs` that aren't already present.
+
+    Only the affected `user_groups` rows are read and written, so the cost
+    grows with the number of pairs rather than with the size of the user or
+    group.  Returns the sorted list of pairs actually added.
+    """
+    pairs = set(pairs)
+    added = sorted(pairs - existing_memberships(pairs))
+    if added:
+        db.session.execute(user_groups.insert(),
+                           [{'user_id': u, 'group_id': g} for u, g in added])
+        touch([u for u, _ in added], [g for _, g in added])
+        update_counts(added=added)
+        log_changes('membership', 'add', added)
+    return added
+
+
+def remove_memberships(pairs):
+    """Delete the (user_id, group_id) `pairs` that are present.
+
+    Returns the sorted list of pairs actually removed.
+    """
+    removed = sorted(existing_memberships(pairs))
+    if removed:
+        stmt = user_groups.delete().where(
+                (user_groups.c.user_id == bindparam('u')) &
+                (user_groups.c.group_id == bindparam('g')))
+        db.session.execute(stmt, [{'u': u, 'g': g} for u, g in removed])
+        touch([u for u, _ in removed], [g for _, g in removed])
+        update_counts(removed=removed)
+        log_changes('membership', 'remove', removed)
+    return removed
+
+
+def clear_memberships(owner, owner_id, limit=None):
+    """Delete the memberships of one user or group, or the first `limit`.
+
+    `owner` names the `user_groups` column that `owner_id` is in.  Unlike
+    `remove_memberships`, nothing is read first: the change log, the other
+    sides' versions and counts, and the memberships themselves are each
+    written with one set-based statement, however many there are.  Returns
+    the number of memberships deleted.
+    """
+    owner_col = user_groups.c[owner]
+    other_col = user_groups.c['group_id' if owner == 'user_id' else 'user_id']
+    model, other = (User, Group) if owner == 'user_id' else (Group, User)
+    selected = select([other_col]).where(owner_col == owner_id)
+    chosen = owner_col == owner_id
+    if limit is not None:
+        selected = selected.order_by(other_col).limit(limit)
+        chosen = chosen & other_col.in_(selected)
+    if cache.backend is not None:
+        # Cache entries can only be dropped by key
+        db.session.info.setdefault('touched', set()).update(
+                (other.__tablename__, id_)
+                for id_, in db.session.execute(selected))
+
+    lock_change_log()
+    db.session.execute(change_log.insert().from_select(
+            ['kind', 'op', 'id', 'other_id'],
+            select([literal('membership'), literal('remove'),
+                    user_groups.c.user_id, user_groups.c.group_id])
+            .where(chosen)))
+    table = other.__table__
+    count = table.c['member_count' if other is Group else 'group_count']
+    db.session.execute(table.update()
+                            .where(table.c.id.in_(selected))
+                            .values({count: count - 1,
+                                     table.c.version: table.c.version + 1}))
+    deleted = db.session.execute(user_groups.delete().where(chosen)).rowcount
+    if deleted:
+        table = model.__table__
+        count = table.c['group_count' if model is User else 'member_count']
+        db.session.execute(table.update()
+                                .where(table.c.id == owner_id)
+                                .values({count: count - deleted}))
+        touch(**{'user_ids' if model is User else 'group_ids': [owner_id]})
+    return deleted
+
+
+def delete_entity(model, id_):
+    """Delete a user or group and everything about it, in one transaction.
+
+    Only set-based statements are used (see `clear_memberships`), so the
+    cost doesn't grow with memberships read into memory.
+    """
+    clear_memberships('user_id' if model is User else 'group_id', id_)
+    if model is Group:
+        unnest_group(id_)
+    touch(**{'user_ids' if model is User else 'group_ids': [id_]})
+    log_changes(model.__name__.lower(), 'delete', [id_])
+    db.session.execute(model.__table__.delete().where(model.id == id_))
+
+
+def delete_in_background(app, model, id_):
+    """Delete a user or group, `DELETE_CHUNK_SIZE` memberships at a time.
+
+    Run in its own thread.  Each chunk is committed separately, letting
+    other writers in between, and the user or group itself goes last.
+    """
+    owner = 'user_id' if model is User else 'group_id'
+    with app.app_context():
+        try:
+            while clear_memberships(owner, id_, DELETE_CHUNK_SIZE):
+                db.session.commit()
+            if existing_ids(model, [id_]):
+                delete_entity(model, id_)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Deleting %s %s failed',
+                                 model.__tablename__, id_)
+
+
+def membership_pairs(owner, owner_id, ids):
+    """Return (user_id, group_id) pairs linking one user or group to `ids`."""
+    if owner == 'user_id':
+        return [(owner_id, id_) for id_ in ids]
+    return [(id_, owner_id) for id_ in ids]
+
+
+def set_memberships(owner, owner_id, ids):
+    """Make `ids` the full membership list of one user or group.
+
+    Only the difference from the current memberships is written.
+    """
+    current = set(load_memberships(owner, [owner_id])[owner_id])
+    ids = set(ids)
+    remove_memberships(membership_pairs(owner, owner_id, current - ids))
+    add_memberships(membership_pairs(owner, owner_id, ids - current))
+
+
+def init_closure(group_ids):
+    """Add the closure rows relating newly created groups to themselves."""
+    if group_ids:
+        db.session.execute(group_closure.insert(),
+                           [{'ancestor_id': g, 'descendant_id': g, 'paths': 1}
+                            for g in group_ids])
+
+
+def update_closure(parent_id, child_id, sign):
+    """Add (sign=1) or remove (sign=-1) the paths through one edge.
+
+    Every ancestor of the parent gains or loses paths to every descendant of
+    the child; pairs left with no paths are deleted.
+    """
+    c = group_closure.c
+    ancestors = (db.session.query(c.ancestor_id, c.paths)
+                           .filter(c.descendant_id == parent_id).all())
+    descendants = (db.session.query(c.descendant_id, c.paths)
+                             .filter(c.ancestor_id == child_id).all())
+    delta = {(a, d): a_paths * d_paths
+             for a, a_paths in ancestors
+             for d, d_paths in descendants}
+
+    current = {}
+    for a_chunk in chunks(sorted({a for a, _ in ancestors})):
+        for d_chunk in chunks(sorted({d for d, _ in descendants})):
+            rows = (db.session.query(c.ancestor_id, c.descendant_id, c.paths)
+                              .filter(c.ancestor_id.in_(a_chunk),
+                                      c.descendant_id.in_(d_chunk)))
+            current.update(((a, d), paths) for a, d, paths in rows)
+
+    inserts, updates, deletes = [], [], []
+    for (a, d), paths in delta.items():
+        row = {'a': a, 'd': d, 'paths': current.get((a, d), 0) + sign * paths}
+        if (a, d) not in current:
+            inserts.append(row)
+        elif row['paths']:
+            updates.append(row)
+        else:
+            deletes.append(row)
+
+    pair = ((c.ancestor_id == bindparam('a')) &
+            (c.descendant_id == bindparam('d')))
+    if inserts:
+        db.session.execute(group_closure.insert().values(
+                ancestor_id=bindparam('a'), descendant_id=bindparam('d'),
+                paths=bindparam('paths')), inserts)
+    if updates:
+        db.session.execute(group_closure.update().where(pair).values(
+                paths=bindparam('paths')), updates)
+    if deletes:
+        db.session.execute(group_closure.delete().where(pair), deletes)
+
+
+def is_subgroup(group_id, ancestor_id):
+    """Return whether a group is (transitively) inside another, or is it."""
+    c = group_closure.c
+    return db.session.query(exists().where(
+            (c.ancestor_id == ancestor_id) &
+            (c.descendant_id == group_id))).scalar()
+
+
+def load_subgroups(parent_id):
+    """Return the sorted ids of a group's direct subgroups."""
+    return [child_id for child_id, in
+            db.session.query(group_groups.c.child_id)
+                      .filter(group_groups.c.parent_id == parent_id)
+                      .order_by(group_groups.c.child_id)]
+
+
+def add_subgroups(parent_id, child_ids):
+    """Make groups direct subgroups of a group, updating the closure.
+
+    Raises ValidationError, leaving the transaction to be rolled back, if
+    that would make a group contain itself.  Returns the sorted ids of the
+    subgroups actually added.
+    """
+    # Also makes a concurrent transaction wait to add subgroups until this
+    # one commits, so its check for cycles sees the subgroups added here
+    lock_change_log()
+    current = set(load_subgroups(parent_id))
+    added = sorted(set(child_ids) - current)
+    for child_id in added:
+        if is_subgroup(parent_id, child_id):
+            raise ValidationError(
+                    'Group {} is in group {}, so it cannot contain it.'
+                    .format(parent_id, child_id))
+        db.session.execute(group_groups.insert(),
+                           {'parent_id': parent_id, 'child_id': child_id})
+        update_closure(parent_id, child_id, 1)
+    log_changes('subgroup', 'add', [(parent_id, c) for c in added])
+    return added
+
+
+def remove_subgroups(parent_id, child_ids):
+    """Remove direct subgroups of a group, updating the closure.
+
+    Returns the sorted ids of the subgroups actually removed.
+    """
+    # Before updating the closure, like `add_subgroups`, so neither waits
+    # for the other's closure rows while holding the lock
+    lock_change_log()
+    current = set(load_subgroups(parent_id))
+    removed = sorted(current.intersection(child_ids))
+    for child_id in removed:
+        db.session.execute(group_groups.delete().where(
+                (group_groups.c.parent_id == parent_id) &
+                (group_groups.c.child_id == child_id)))
+        update_closure(parent_id, child_id, -1)
+    log_changes('subgroup', 'remove', [(parent_id, c) for c in removed])
+    return removed
+
+
+def unnest_group(group_id):
+    """Remove a group from the group hierarchy, before deleting it."""
+    parents = [parent_id for parent_id, in
+               db.session.query(group_groups.c.parent_id)
+                         .filter(group_groups.c.child_id == group_id)]
+    for parent_id in parents:
+        remove_subgroups(parent_id, [group_id])
+    remove_subgroups(group_id, load_subgroups(group_id))
+    db.session.execute(group_closure.delete().where(
+            group_closure.c.ancestor_id == group_id))
+
+
+def effective_groups(user_id):
+    """Query the ids of the groups a user is in, directly or through nesting.
+
+    This is a single indexed join against the closure table.
+    """
+    c = group_closure.c
+    return (db.session.query(c.ancestor_id.label('id'))
+                      .join(user_groups, user_groups.c.group_id == c.descendant_id)
+                      .filter(user_groups.c.user_id == user_id)
+                      .distinct())
+
+
+def effective_users(group_id):
+    """Query the ids of the users in a group, directly or through nesting.
+
+    This is a single indexed join against the closure table.
+    """
+    c = group_closure.c
+    return (db.session.query(user_groups.c.user_id.label('id'))
+                      .join(group_closure,
+                            user_groups.c.group_id == c.descendant_id)
+                      .filter(c.ancestor_id == group_id)
+                      .distinct())
+
+
+def group_users(group_id):
+    """Query the ids of a group's direct users."""
+    return (db.session.query(user_groups.c.user_id.label('id'))
+                      .filter(user_groups.c.group_id == group_id))
+
+
+# Compound select of each set operator
+SET_OPERATIONS = {'and': intersect, 'or': union, 'minus': except_}
+
+
+def set_operands(op, args):
+    """Return the operands of `op`, merging in those of nested `op`s.
+
+    (a and b) and c is a and b and c, likewise for or, and (a minus b)
+    minus c is a minus b minus c; but a minus (b minus c) is not.
+    """
+    operands = []
+    for i, arg in enumerate(args):
+        if isinstance(arg, dict) and op in arg and (op != 'minus' or i == 0):
+            operands.extend(set_operands(op, arg[op]))
+        else:
+            operands.append(arg)
+    return operands
+
+
+def expr_select(expr, effective=False):
+    """Compile a set expression over groups into a select of user ids.
+
+    Group ids select their users (including those of subgroups if
+    `effective`), and the operators become INTERSECT, UNION and EXCEPT.
+    Operations only nest where the expression switches operators, each in
+    a single subquery, since SQLite's parser runs out of stack on deep ones.
+    """
+    if isinstance(expr, int):
+        query = effective_users(expr) if effective else group_users(expr)
+        return query.statement
+    (op, args), = expr.items()
+    selects = [expr_select(arg, effective) for arg in set_operands(op, args)]
+    if len(selects) == 1:
+        return selects[0]
+    # SQLite can't use a compound select as an operand of another one, but
+    # can select from it
+    return select([SET_OPERATIONS[op](*selects).alias().c.id])
+
+
+def compile_expr(expr, effective=False):
+    """Compile a set expression over groups into a query of user ids.
+
+    The whole expression is evaluated by the database in one query (see
+    `expr_select`).
+    """
+    return db.session.query(expr_select(expr, effective).alias().c.id)
+
+
+def count_ids(query):
+    """Return the number of rows selected by `query`."""
+    return (db.session.query(func.count())
+                      .select_from(query.subquery())
+                      .scalar())
+
+
+def paginate_ids(query, args):
+    """Return a page of the ids selected by `query`, and the next cursor.
+
+    Like `paginate`, but for queries selecting a single ``id`` column.
+    """
+    limit = args.get('limit', PAGE_SIZE)
+    after = args.get('after', 0)
+    subquery = query.subquery()
+    ids = [id_ for id_, in
+           db.session.query(subquery.c.id)
+                     .filter(subquery.c.id > after)
+                     .order_by(subquery.c.id)
+                     .limit(limit + 1)]
+    if len(ids) > limit:
+        ids = ids[:limit]
+        return ids, ids[-1]
+    return ids, None
+
+
+def bulk_save(model, schema, items, upsert=False):
+    """Validate and insert many Users or Groups in a single transaction.
+
+    All items are validated in one pass, membership ids and name conflicts
+    are checked with batched IN queries, and rows are written with
+    executemany.  Items whose name is already taken are reported as
+    conflicts, or updated in place if `upsert` is true.
+
+    Returns a list with one result per item, in order, each holding an HTTP
+    style ``status`` and either the ``id`` or the reason for failure.
+    """
+    if model is User:
+        label, members, owner, other, other_key = (
+                'User', 'groups', 'user_id', Group, 'group_id')
+    else:
+        label, members, owner, other, other_key = (
+                'Group', 'users', 'group_id', User, 'user_id')
+    table = model.__table__
+    columns = [name for name, field in schema.fields.items()
+               if name not in ('id', members) and not field.dump_only]
+
+    # Validate and deserialize input
+    results = [None] * len(items)
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {'status': 422,
+                          'errors': {'_schema': ['Invalid input type.']}}
+            items[i] = {}
+    data, errors = schema.load(items)
+    for i, error in errors.items():
+        if results[i] is None:
+            results[i] = {'status': 422, 'errors': error}
+
+    valid = {}
+    for i, item in enumerate(data):
+        if results[i] is not None:
+            continue
+        if item['name'] in valid:
+            results[i] = {'status': 409,
+                          'message': "Duplicate name in request."}
+        else:
+            valid[item['name']] = i
+
+    found = existing_ids(other, {id_ for i in valid.values()
+                                 for id_ in data[i].get(members, [])})
+    for name, i in list(valid.items()):
+        if not found.issuperset(data[i].get(members, [])):
+            message = 'Not all supplied {} exist'.format(members)
+            results[i] = {'status': 422, 'errors': {members: [message]}}
+            del valid[name]
+
+    ids = existing_names(model, valid)
+    inserts, updates = [], []
+    for name, i in valid.items():
+        if name not in ids:
+            inserts.append(i)
+        elif upsert:
+            updates.append(i)
+        else:
+            results[i] = {'status': 409,
+                          'message': "{} exists.".format(label)}
+
+    # Write everything in one transaction
+    if inserts:
+        db.session.execute(table.insert(),
+                           [{c: data[i][c] for c in columns}
+                            for i in inserts])
+        ids.update(existing_names(model, [data[i]['name'] for i in inserts]))
+        if model is Group:
+            init_closure([ids[data[i]['name']] for i in inserts])
+
+    changed = [c for c in columns if c != 'name']
+    if updates and changed:
+        stmt = (table.update()
+                     .where(table.c.id == bindparam('_id'))
+                     .values({c: bindparam('_' + c) for c in changed}))
+        db.session.execute(stmt, [dict({'_' + c: data[i][c] for c in changed},
+                                       _id=ids[data[i]['name']])
+                                  for i in updates])
+
+    replaced = [ids[data[i]['name']] for i in updates if members in data[i]]
+    previous = load_memberships(owner, replaced)
+    for chunk in chunks(replaced):
+        db.session.execute(user_groups.delete()
+                                      .where(user_groups.c[owner].in_(chunk)))
+
+    rows = [{owner: ids[data[i]['name']], other_key: id_}
+            for i in inserts + updates
+            for id_ in set(data[i].get(members, []))]
+    if rows:
+        db.session.execute(user_groups.insert(), rows)
+
+    touched = {owner: [ids[data[i]['name']] for i in updates],
+               other_key: [id_ for others in previous.values()
+                           for id_ in others] +
+                          [row[other_key] for row in rows]}
+    touch(touched['user_id'], touched['group_id'])
+
+    kind = label.lower()
+    log_changes(kind, 'create', [ids[data[i]['name']] for i in inserts])
+    log_changes(kind, 'update', [ids[data[i]['name']] for i in updates])
+    # Replaced memberships were all deleted and reinserted; log the net change
+    new = {(row['user_id'], row['group_id']) for row in rows}
+    old = {pair for id_, others in previous.items()
+           for pair in membership_pairs(owner, id_, others)}
+    update_counts(added=new - old, removed=old - new)
+    log_changes('membership', 'remove', sorted(old - new))
+    log_changes('membership', 'add', sorted(new - old))
+    db.session.commit()
+
+    for i in inserts:
+        results[i] = {'status': 201, 'id': ids[data[i]['name']]}
+    for i in updates:
+        results[i] = {'status': 200, 'id': ids[data[i]['name']]}
+    return results
+
+
+# Write batching
+
+
+class WriteBatcher(object):
+    """Runs write requests in batches, committing each batch once.
+
+    Views wrapped with `batched` hand their request to a single background
+    thread, which waits up to `window` seconds after the first one for up to
+    `size` of them, runs each in a savepoint of one transaction, and
+    commits.  The commit (and the wait for the database's write lock) is
+    then shared by the whole batch, and each request gets the response its
+    view returned or the exception it raised.  Meanwhile the session's
+    `commit` and `rollback` only end savepoints (see `RoutingSession`), so
+    a write that fails or rolls back only undoes its own.  If the batch
+    can't be committed, its writes are run again one at a time.
+    """
+
+    def __init__(self, app, window, size):
+        self.app = app
+        self.window = window
+        self.size = size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, view):
+        """Run `view` (a function of no arguments) in the next batch.
+
+        Called in a request, whose context `view` runs in.  Returns what
+        `view` returns, once its batch has committed.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+        request_metrics = current_metrics()
+
+        @copy_current_request_context
+        def job():
+            # Count the job's SQL in its request's metrics, without the
+            # copied context's teardown recording the request early
+            g.metrics = request_metrics
+            try:
+                return view()
+            finally:
+                g.pop('metrics', None)
+
+        future = Future()
+        self._queue.put((job, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(jobs) < self.size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self.app.app_context():
+                try:
+                    self._apply(jobs)
+                except Exception as exc:
+                    # Don't leave the requests waiting forever
+                    for _, future in jobs:
+                        if not future.done():
+                            future.set_exception(exc)
+
+    def _apply(self, jobs):
+        session = db.session()
+        try:
+            if session.get_bind().dialect.name == 'sqlite':
+                # pysqlite only begins transactions before writes, so the
+                # first savepoint would begin one and releasing it commit it
+                session.execute('BEGIN IMMEDIATE')
+            session.begin_savepoint()
+            results = [self._call(job) for job, _ in jobs]
+            session.end_savepoints()
+            session.commit()
+        except Exception:
+            session.end_savepoints(release=False)
+            session.rollback()
+            self.app.logger.exception('Committing a batch of %d writes '
+                                      'failed; retrying them one by one',
+                                      len(jobs))
+            results = [self._call(job) for job, _ in jobs]
+        for (_, future), (result, error) in zip(jobs, results):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _call(self, job):
+        """Run a job, then commit, or roll back if it raised.
+
+        In a batch, that only ends the job's savepoint.  Returns its result
+        and exception (one of them None).
+        """
+        session = db.session()
+        try:
+            result = job()
+            # Views commit their own writes, but may return before writing
+            session.commit()
+        except Exception as exc:
+            session.rollback()
+            return None, exc
+        return result, None
+
+
+def batched(view):
+    """Run a view through the app's `WriteBatcher`, if it has one."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        batcher = current_app.extensions['grouper_batcher']
+        if batcher is None:
+            return view(*args, **kwargs)
+        return batcher.submit(partial(view, *args, **kwargs))
+    return wrapper
+
+
+# Response encodings
+
+
+def gzip_compressor():
+    stream = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (stream.compress, lambda: stream.flush(zlib.Z_SYNC_FLUSH),
+            stream.flush)
+
+
+def brotli_compressor():
+    stream = brotli.Compressor(quality=4)
+    return stream.process, stream.flush, stream.finish
+
+
+def zstd_compressor():
+    stream = zstandard.ZstdCompressor(level=3).compressobj()
+    return (stream.compress,
+            lambda: stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            stream.flush)
+
+
+# Content codings we can produce, in order of preference, each with a
+# function returning a new compressor's (compress, flush, finish) functions
+CONTENT_ENCODINGS = OrderedDict(
+        (name, compressor) for name, compressor, module in [
+            ('zstd', zstd_compressor, zstandard),
+            ('br', brotli_compressor, brotli),
+            ('gzip', gzip_compressor, zlib),
+        ] if module is not None)
+
+
+def compressed_chunks(chunks, compressor, charset):
+    """Compress a streamed body, flushing after each chunk."""
+    compress, flush, finish = compressor
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compress(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def pack_response(response):
+    """Re-encode a JSON response's body as MessagePack."""
+    data = msgpack.packb(json.loads(response.get_data()))
+    response.set_data(data)
+    response.mimetype = MSGPACK_MIMETYPE
+
+
+def compress_response(response):
+    """Compress a response with the best encoding the client accepts.
+
+    Streamed responses are always compressed, others only from
+    GROUPER_COMPRESS_MIN_SIZE bytes.  A compressed body is no longer the
+    same bytes as an uncompressed one, so the ETag of every response that
+    may be compressed is weak.
+    """
+    min_size = current_app.config['GROUPER_COMPRESS_MIN_SIZE']
+    if (not min_size or response.status_code < 200 or
+            response.status_code == 204 or
+            'Content-Encoding' in response.headers):
+        return
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(list(CONTENT_ENCODINGS))
+    if encoding is None:
+        return
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    if response.status_code == 304:
+        return
+
+    compressor = CONTENT_ENCODINGS[encoding]()
+    if response.is_streamed:
+        response.response = compressed_chunks(response.response, compressor,
+                                              response.charset)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return
+        compress, _, finish = compressor
+        response.set_data(compress(data) + finish())
+    response.headers['Content-Encoding'] = encoding
+
+
+@api.after_app_request
+def negotiate_encoding(response):
+    """Encode a response as the client prefers.
+
+    JSON bodies become MessagePack for clients that prefer it (if the
+    msgpack package is installed), and then any body is compressed with
+    zstd, Brotli or gzip, whichever the client accepts and is installed.
+    """
+    if msgpack is not None and response.mimetype in ('application/json',
+                                                     MSGPACK_MIMETYPE):
+        response.vary.add('Accept')
+        if (response.mimetype == 'application/json' and
+                not response.is_streamed and
+                preferred_mimetype() == MSGPACK_MIMETYPE):
+            pack_response(response)
+    compress_response(response)
+    return response
 
 
 # API (Flask views)
 
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return make_response(jsonify({'message': 'Not found'}), 404)
 
 
+def entity_etag(model, id_, version, only=None):
+    """Return the ETag of a User or Group at the given version.
+
+    Sparse representations (see `requested_fields`) and MessagePack ones
+    get their own ETags.
+    """
+    etag = '{}-{}-{}'.format(model.__tablename__, id_, version)
+    if only is not None:
+        etag += ';' + ','.join(only)
+    if preferred_mimetype() == MSGPACK_MIMETYPE:
+        etag += '+msgpack'
+    return etag
+
+
+def requested_fields(schema_class):
+    """Return the sorted field names requested with ?fields=, or None.
+
+    Names may also be aliases from the schema's `field_aliases`.  Raises
+    ValidationError if any of them isn't a field of `schema_class`.
+    """
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    names = {name.strip() for name in value.split(',')} - {''}
+    if not names:
+        raise ValidationError('No fields requested.')
+    aliases = getattr(schema_class, 'field_aliases', {})
+    names = {aliases.get(name, name) for name in names}
+    unknown = names - set(schema_class._declared_fields)
+    if unknown:
+        raise ValidationError('Unknown fields: {}'.format(
+                              ', '.join(sorted(unknown))))
+    return tuple(sorted(names))
+
+
+def not_modified(model, id_, only=None):
+    """Answer a conditional GET from the version column alone.
+
+    Returns a 304 response if the client's If-None-Match matches the current
+    version of the `model` with `id_`, and None otherwise (including when it
+    doesn't exist), without loading or serializing anything.
+    """
+    if not request.if_none_match:
+        return None
+    version = db.session.query(model.version).filter_by(id=id_).scalar()
+    if version is None:
+        return None
+    etag = entity_etag(model, id_, version, only)
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def entity_response(model, id_, version, text, only=None):
+    """Return the response for one serialized User or Group, with its ETag.
+
+    The body matches what `jsonify` would produce for the same data.
+    """
+    key = 'user' if model is User else 'group'
+    body = '{{"{}":{}}}\n'.format(key, text)
+    response = current_app.response_class(
+            body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+    response.set_etag(entity_etag(model, id_, version, only))
+    return response
+
+
+def fast_reads(args):
+    """Return whether to serve a read through the fast path.
+
+    `args` are the request's deserialized query arguments, whose `fast`
+    overrides the GROUPER_FAST_READS setting.  The fast path only matches
+    `jsonify` output under Flask's default JSON settings, so it is never
+    used with others.
+    """
+    config = current_app.config
+    return bool(args.get('fast', config['GROUPER_FAST_READS']) and
+                config['JSON_SORT_KEYS'] and config['JSON_AS_ASCII'] and
+                not config['JSONIFY_PRETTYPRINT_REGULAR'] and
+                not current_app.debug)
+
+
+def route_to_replica(args):
+    """Send the rest of the request's reads to the next read replica.
+
+    Reads stay on the primary if there are no replicas, if `args` (the
+    request's deserialized query arguments) ask for it with `primary`, or if
+    the client wrote less than GROUPER_REPLICA_LAG seconds ago, as a replica
+    may not have its write yet (see `remember_write`).
+    """
+    replicas = current_app.extensions['grouper_replicas']
+    if replicas is None or args.get('primary'):
+        return
+    try:
+        wrote = float(request.cookies.get(WRITE_COOKIE, ''))
+    except ValueError:
+        pass
+    else:
+        if time.time() - wrote < current_app.config['GROUPER_REPLICA_LAG']:
+            return
+    db.session.info['replica'] = next(replicas)
+
+
+def page_response(key, texts, cursor):
+    """Return a page of pre-serialized Users or Groups, as `jsonify` would."""
+    fields = sorted([(key, '[' + ','.join(texts) + ']'),
+                     ('next', 'null' if cursor is None else str(cursor))])
+    body = '{' + ','.join('"{}":{}'.format(k, v) for k, v in fields) + '}\n'
+    return current_app.response_class(
+            body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def preferred_mimetype():
+    """Return the type of response the client prefers.
+
+    That is JSON (the default), newline-delimited JSON, or MessagePack if
+    the msgpack package is installed.
+    """
+    offered = ['application/json', NDJSON_MIMETYPE]
+    if msgpack is not None:
+        offered.append(MSGPACK_MIMETYPE)
+    return request.accept_mimetypes.best_match(offered, 'application/json')
+
+
+def stream_response(model, mimetype='application/json', only=None,
+                    fast=False, criteria=()):
+    """Return a streaming response holding every User or Group.
+
+    Rows are read from a server-side cursor (where the database supports
+    one) and serialized `CHUNK_SIZE` at a time, so memory use stays flat and
+    the first bytes go out before the first query runs.  The body is, by
+    `mimetype`, a JSON document like that of a single page without the
+    cursor, one JSON object per line, or one MessagePack map after another.
+    If `fast` is true, rows are serialized with `fast_encoder` instead of
+    the schema.  Only rows matching all of `criteria` are included.
+    """
+    key = model.__tablename__
+    dump = dump_users if model is User else dump_groups
+
+    def schema_chunks():
+        rows = iter(model.query.filter(*criteria)
+                               .order_by(model.id)
+                               .execution_options(stream_results=True)
+                               .yield_per(CHUNK_SIZE))
+        chunk = list(islice(rows, CHUNK_SIZE))
+        while chunk:
+            yield [json.dumps(d, separators=(',', ':'))
+                   for d in dump(chunk, only)]
+            chunk = list(islice(rows, CHUNK_SIZE))
+
+    def fast_chunks():
+        columns, _ = fast_encoder(model, only)
+        result = db.session.execute(select(columns)
+                                    .where(and_(*criteria))
+                                    .order_by(model.id)
+                                    .execution_options(stream_results=True))
+        rows = result.fetchmany(CHUNK_SIZE)
+        while rows:
+            yield fast_dump(model, rows, only)
+            rows = result.fetchmany(CHUNK_SIZE)
+
+    def generate():
+        if mimetype == 'application/json':
+            yield '{{"{}":['.format(key)
+        first = True
+        for texts in (fast_chunks() if fast else schema_chunks()):
+            if mimetype == MSGPACK_MIMETYPE:
+                yield b''.join(msgpack.packb(json.loads(text))
+                               for text in texts)
+            elif mimetype == NDJSON_MIMETYPE:
+                yield '\n'.join(texts) + '\n'
+            else:
+                yield ('' if first else ',') + ','.join(texts)
+            first = False
+        if mimetype == 'application/json':
+            yield ']}\n'
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype=mimetype)
+
+
+@api.route(API_URL + '/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify({'cache': cache.stats()}), 200
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Expose request and cache metrics in the Prometheus text format."""
+    lines = []
+    for metric in metrics.values():
+        lines.extend(metric.expose())
+    stats = cache.stats()
+    for key in ('hits', 'misses'):
+        name = 'grouper_cache_{}_total'.format(key)
+        lines.extend(['# HELP {} Serialized cache {}.'.format(name, key),
+                      '# TYPE {} counter'.format(name),
+                      '{} {}'.format(name, stats[key])])
+    if 'entries' in stats:
+        lines.extend(['# HELP grouper_cache_entries Serialized cache entries.',
+                      '# TYPE grouper_cache_entries gauge',
+                      'grouper_cache_entries {}'.format(stats['entries'])])
+    return current_app.response_class('\n'.join(lines) + '\n',
+                                      mimetype=PROMETHEUS_MIMETYPE), 200
+
+
 ## User Resource
 
 
-@app.route(API_URL + '/users', methods=['GET'])
+@api.route(API_URL + '/users', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    result = users_schema.dump(users)
-    return jsonify({'users': result.data}), 200
-
-@app.route(API_URL + '/users/<int:user_id>', methods=['GET'])
+    args, errors = user_page_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    try:
+        only = requested_fields(UserSchema)
+    except ValidationError as err:
+        return jsonify({'fields': err.messages}), 422
+
+    route_to_replica(args)
+    criteria = search_criteria(User, args)
+    fast = fast_reads(args)
+    mimetype = preferred_mimetype()
+    if mimetype == NDJSON_MIMETYPE or args.get('stream'):
+        return stream_response(User, mimetype, only, fast, criteria)
+
+    if fast:
+        return page_response('users', *fast_paginate(User, args, only,
+                                                    criteria)), 200
+    users, cursor = paginate(User, args, criteria)
+    return jsonify({'users': dump_users(users, only), 'next': cursor}), 200
+
+@api.route(API_URL + '/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     try:
         validate_id(user_id)
     except ValidationError:
         return jsonify({"message": "User could not be found."}), 404
 
-    user = User.query.get(user_id)
-    if user is None:
+    args, errors = read_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    try:
+        only = requested_fields(UserSchema)
+    except ValidationError as err:
+        return jsonify({'fields': err.messages}), 422
+
+    route_to_replica(args)
+    cached = not_modified(User, user_id, only)
+    if cached is not None:
+        return cached
+
+    value = serialize(User, user_id, only, fast_reads(args))
+    if value is None:
         return jsonify({"message": "User could not be found."}), 404
     else:
-        user_result = user_schema.dump(user)
-        return jsonify({'user': user_result.data}), 200
+        return entity_response(User, user_id, *value, only=only)
 
-@app.route(API_URL + '/users/<int:user_id>', methods=['DELETE'])
+@api.route(API_URL + '/users/<int:user_id>', methods=['DELETE'])
+@batched
 def delete_user(user_id):
     try:
         validate_id(user_id)
     except ValidationError:
         return jsonify({"message": "User could not be found."}), 404
 
-    user = User.query.get(user_id)
-    if user is None:
+    args, errors = delete_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    if not existing_ids(User, [user_id]):
         return jsonify({"message": "User could not be found."}), 404
-    else:
-        db.session.delete(user)
-        db.session.commit()
-        return jsonify({'message': 'User deleted.'}), 200
 
-@app.route(API_URL + '/users', methods=['POST'])
+    if args.get('background'):
+        threading.Thread(target=delete_in_background, daemon=True,
+                         args=(current_app._get_current_object(), User,
+                               user_id)).start()
+        return jsonify({'message': 'User deletion started.'}), 202
+    delete_entity(User, user_id)
+    db.session.commit()
+    return jsonify({'message': 'User deleted.'}), 200
+
+@api.route(API_URL + '/users', methods=['POST'])
+@batched
 def add_user():
     json_data = request.get_json()
     if not json_data:
@@ -194,23 +2397,48 @@ def add_user():
         return jsonify(errors), 422
 
     name = data['name']
-    if User.query.filter_by(name=name).count() != 0:
-        return jsonify({'message': "User exists."}), 409
-
     email = data['email']
     groups = data.get('groups', [])
 
-    # Create a new User
-    user = User(name=name, email=email, groups=groups)
+    # Create a new User, letting the unique index catch existing names
+    user = User(name=name, email=email)
     db.session.add(user)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': "User exists."}), 409
+    log_changes('user', 'create', [user.id])
+    add_memberships(membership_pairs('user_id', user.id, groups))
     db.session.commit()
 
     # Return
-    result = user_schema.dump(User.query.get(user.id))
     return jsonify({'message': 'User added.',
-                    'user': result.data}), 201
+                    'user': dump_users([user])[0]}), 201
+
+@api.route(API_URL + '/users/bulk', methods=['POST'])
+@batched
+def add_users():
+    json_data = request.get_json()
+    if not isinstance(json_data, dict) or not json_data.get('users'):
+        return jsonify({'message': "No input data provided."}), 400
 
-@app.route(API_URL + '/users/<int:user_id>', methods=['PUT'])
+    items = json_data['users']
+    if not isinstance(items, list):
+        return jsonify({'users': ['Not a valid list.']}), 422
+    if len(items) > MAX_BULK_SIZE:
+        return jsonify({'message': "Too many users."}), 413
+
+    try:
+        results = bulk_save(User, user_bulk_schema, items,
+                            upsert=bool(json_data.get('upsert')))
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': "Users changed concurrently."}), 409
+    return jsonify({'users': results}), 200
+
+@api.route(API_URL + '/users/<int:user_id>', methods=['PUT'])
+@batched
 def modify_user(user_id):
     json_data = request.get_json()
     if not json_data:
@@ -228,66 +2456,111 @@ def modify_user(user_id):
     # Validate and deserialize input
     name = json_data.get('name', user.name)
     email = json_data.get('email', user.email)
-    groups = json_data.get('groups', user.groups.all())
+    changes = dict(name=name, email=email)
+    if 'groups' in json_data:
+        changes['groups'] = json_data['groups']
 
-    data, errors = user_schema.load(
-            dict(name=name, email=email, groups=groups))
+    data, errors = user_schema.load(changes)
     if errors:
         return jsonify(errors), 422
 
     # Modify the user
     user.name = data['name']
     user.email = data['email']
-    user.groups = data['groups']
-
     db.session.add(user)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': "User exists."}), 409
+    log_changes('user', 'update', [user.id])
+    if 'groups' in data:
+        set_memberships('user_id', user.id, data['groups'])
+    touch(user_ids=[user.id])
     db.session.commit()
 
     # Return
-    result = user_schema.dump(User.query.get(user.id))
     return jsonify({'message': 'User added.',
-                    'user': result.data}), 200
+                    'user': dump_users([user])[0]}), 200
 
 
 ## Group Resource
 
 
-@app.route(API_URL + '/groups', methods=['GET'])
+@api.route(API_URL + '/groups', methods=['GET'])
 def get_groups():
-    groups = Group.query.all()
-    result = groups_schema.dump(groups)
-    return jsonify({'groups': result.data}), 200
-
-@app.route(API_URL + '/groups/<int:group_id>', methods=['GET'])
+    args, errors = group_page_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    try:
+        only = requested_fields(GroupSchema)
+    except ValidationError as err:
+        return jsonify({'fields': err.messages}), 422
+
+    route_to_replica(args)
+    criteria = search_criteria(Group, args)
+    fast = fast_reads(args)
+    mimetype = preferred_mimetype()
+    if mimetype == NDJSON_MIMETYPE or args.get('stream'):
+        return stream_response(Group, mimetype, only, fast, criteria)
+
+    if fast:
+        return page_response('groups', *fast_paginate(Group, args, only,
+                                                    criteria)), 200
+    groups, cursor = paginate(Group, args, criteria)
+    return jsonify({'groups': dump_groups(groups, only), 'next': cursor}), 200
+
+@api.route(API_URL + '/groups/<int:group_id>', methods=['GET'])
 def get_group(group_id):
     try:
         validate_id(group_id)
     except ValidationError:
         return jsonify({"message": "Group could not be found."}), 404
 
-    group = Group.query.get(group_id)
-    if group is None:
+    args, errors = read_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    try:
+        only = requested_fields(GroupSchema)
+    except ValidationError as err:
+        return jsonify({'fields': err.messages}), 422
+
+    route_to_replica(args)
+    cached = not_modified(Group, group_id, only)
+    if cached is not None:
+        return cached
+
+    value = serialize(Group, group_id, only, fast_reads(args))
+    if value is None:
         return jsonify({"message": "Group could not be found."}), 404
     else:
-        group_result = group_schema.dump(group)
-        return jsonify({'group': group_result.data}), 200
+        return entity_response(Group, group_id, *value, only=only)
 
-@app.route(API_URL + '/groups/<int:group_id>', methods=['DELETE'])
+@api.route(API_URL + '/groups/<int:group_id>', methods=['DELETE'])
+@batched
 def delete_group(group_id):
     try:
         validate_id(group_id)
     except ValidationError:
         return jsonify({"message": "Group could not be found."}), 404
 
-    group = Group.query.get(group_id)
-    if group is None:
+    args, errors = delete_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    if not existing_ids(Group, [group_id]):
         return jsonify({"message": "Group could not be found."}), 404
-    else:
-        db.session.delete(group)
-        db.session.commit()
-        return jsonify({'message': 'Group deleted.'}), 200
 
-@app.route(API_URL + '/groups', methods=['POST'])
+    if args.get('background'):
+        threading.Thread(target=delete_in_background, daemon=True,
+                         args=(current_app._get_current_object(), Group,
+                               group_id)).start()
+        return jsonify({'message': 'Group deletion started.'}), 202
+    delete_entity(Group, group_id)
+    db.session.commit()
+    return jsonify({'message': 'Group deleted.'}), 200
+
+@api.route(API_URL + '/groups', methods=['POST'])
+@batched
 def add_group():
     json_data = request.get_json()
     if not json_data:
@@ -299,22 +2572,48 @@ def add_group():
         return jsonify(errors), 422
 
     name = data['name']
-    if Group.query.filter_by(name=name).count() != 0:
-        return jsonify({'message': "Group exists."}), 409
-
     users = data.get('users', [])
 
-    # Create a new Group
-    group = Group(name=name, users=users)
+    # Create a new Group, letting the unique index catch existing names
+    group = Group(name=name)
     db.session.add(group)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': "Group exists."}), 409
+    init_closure([group.id])
+    log_changes('group', 'create', [group.id])
+    add_memberships(membership_pairs('group_id', group.id, users))
     db.session.commit()
 
     # Return
-    result = group_schema.dump(Group.query.get(group.id))
     return jsonify({'message': 'Group added.',
-                    'group': result.data}), 201
+                    'group': dump_groups([group])[0]}), 201
 
-@app.route(API_URL + '/groups/<int:group_id>', methods=['PUT'])
+@api.route(API_URL + '/groups/bulk', methods=['POST'])
+@batched
+def add_groups():
+    json_data = request.get_json()
+    if not isinstance(json_data, dict) or not json_data.get('groups'):
+        return jsonify({'message': "No input data provided."}), 400
+
+    items = json_data['groups']
+    if not isinstance(items, list):
+        return jsonify({'groups': ['Not a valid list.']}), 422
+    if len(items) > MAX_BULK_SIZE:
+        return jsonify({'message': "Too many groups."}), 413
+
+    try:
+        results = bulk_save(Group, group_bulk_schema, items,
+                            upsert=bool(json_data.get('upsert')))
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': "Groups changed concurrently."}), 409
+    return jsonify({'groups': results}), 200
+
+@api.route(API_URL + '/groups/<int:group_id>', methods=['PUT'])
+@batched
 def modify_group(group_id):
     json_data = request.get_json()
     if not json_data:
@@ -331,26 +2630,946 @@ def modify_group(group_id):
 
     # Validate and deserialize input
     name = json_data.get('name', group.name)
-    users = json_data.get('users', group.users.all())
+    changes = dict(name=name)
+    if 'users' in json_data:
+        changes['users'] = json_data['users']
 
-    data, errors = group_schema.load(
-            dict(name=name, users=users))
+    data, errors = group_schema.load(changes)
     if errors:
         return jsonify(errors), 422
 
     # Modify the group
     group.name = data['name']
-    group.users = data['users']
-
     db.session.add(group)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': "Group exists."}), 409
+    log_changes('group', 'update', [group.id])
+    if 'users' in data:
+        set_memberships('group_id', group.id, data['users'])
+    touch(group_ids=[group.id])
     db.session.commit()
 
     # Return
-    result = group_schema.dump(Group.query.get(group.id))
     return jsonify({'message': 'Group added.',
-                    'group': result.data}), 200
+                    'group': dump_groups([group])[0]}), 200
+
+
+## Memberships
+
+
+def check_exists(model, id_):
+    """Return a 404 response if there is no `model` with `id_`, else None."""
+    try:
+        validate_id(id_)
+    except ValidationError:
+        id_ = None
+    if id_ is None or not existing_ids(model, [id_]):
+        message = "{} could not be found.".format(model.__name__)
+        return jsonify({'message': message}), 404
+    return None
+
+
+def update_memberships(owner, owner_id, ids):
+    """Add or remove (by request method) memberships of one user or group.
+
+    Returns the sorted ids on the other side whose membership changed.
+    """
+    pairs = membership_pairs(owner, owner_id, ids)
+    if request.method == 'POST':
+        changed = add_memberships(pairs)
+    else:
+        changed = remove_memberships(pairs)
+    db.session.commit()
+    other = 1 if owner == 'user_id' else 0
+    return [pair[other] for pair in changed]
+
+
+def membership_response(changed):
+    """Return the response for adding or removing a single membership."""
+    if request.method == 'POST':
+        if changed:
+            return jsonify({'message': 'Membership added.'}), 201
+        return jsonify({'message': 'Membership exists.'}), 200
+    if changed:
+        return jsonify({'message': 'Membership removed.'}), 200
+    return jsonify({"message": "Membership could not be found."}), 404
+
+def membership_check(user_id, group_id):
+    """Return the response for checking a single membership.
+
+    Nonexistent users and groups are simply not members, so this costs one
+    indexed lookup and nothing else.  With ?effective=1, membership through
+    nested groups counts too.
+    """
+    try:
+        validate_id(user_id)
+        validate_id(group_id)
+    except ValidationError:
+        return jsonify({'member': False}), 404
+
+    args, errors = membership_args_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    if args.get('effective'):
+        member = is_effective_member(user_id, group_id)
+    else:
+        member = is_member(user_id, group_id)
+    if member:
+        return jsonify({'member': True}), 200
+    return jsonify({'member': False}), 404
+
+@api.route(API_URL + '/users/<int:user_id>/groups/<int:group_id>',
+           methods=['GET'])
+def get_user_group(user_id, group_id):
+    return membership_check(user_id, group_id)
+
+@api.route(API_URL + '/groups/<int:group_id>/users/<int:user_id>',
+           methods=['GET'])
+def get_group_user(group_id, user_id):
+    return membership_check(user_id, group_id)
+
+@api.route(API_URL + '/memberships/check', methods=['POST'])
+def check_memberships():
+    json_data = request.get_json()
+    if not json_data:
+        return jsonify({'message': "No input data provided."}), 400
+
+    # Validate and deserialize input
+    data, errors = membership_check_schema.load(json_data)
+    if errors:
+        return jsonify(errors), 422
+
+    pairs = [tuple(pair) for pair in data['pairs']]
+    found = existing_memberships(pairs)
+    return jsonify({'members': [pair in found for pair in pairs]}), 200
+
+@api.route(API_URL + '/users/<int:user_id>/groups/<int:group_id>',
+           methods=['POST', 'DELETE'])
+@batched
+def modify_user_group(user_id, group_id):
+    error = check_exists(User, user_id) or check_exists(Group, group_id)
+    if error:
+        return error
+
+    changed = update_memberships('user_id', user_id, [group_id])
+    return membership_response(changed)
+
+@api.route(API_URL + '/groups/<int:group_id>/users/<int:user_id>',
+           methods=['POST', 'DELETE'])
+@batched
+def modify_group_user(group_id, user_id):
+    error = check_exists(Group, group_id) or check_exists(User, user_id)
+    if error:
+        return error
+
+    changed = update_memberships('group_id', group_id, [user_id])
+    return membership_response(changed)
+
+@api.route(API_URL + '/users/<int:user_id>/groups', methods=['POST', 'DELETE'])
+@batched
+def modify_user_groups(user_id):
+    json_data = request.get_json()
+    if not json_data:
+        return jsonify({'message': "No input data provided."}), 400
+
+    error = check_exists(User, user_id)
+    if error:
+        return error
+
+    # Validate and deserialize input
+    data, errors = membership_schema.load(json_data)
+    if errors:
+        return jsonify(errors), 422
+    if 'groups' not in data:
+        return jsonify({'groups': ['Missing data for required field.']}), 422
+
+    changed = update_memberships('user_id', user_id, data['groups'])
+    key = 'added' if request.method == 'POST' else 'removed'
+    return jsonify({key: changed}), 200
+
+@api.route(API_URL + '/groups/<int:group_id>/users', methods=['POST', 'DELETE'])
+@batched
+def modify_group_users(group_id):
+    json_data = request.get_json()
+    if not json_data:
+        return jsonify({'message': "No input data provided."}), 400
+
+    error = check_exists(Group, group_id)
+    if error:
+        return error
+
+    # Validate and deserialize input
+    data, errors = membership_schema.load(json_data)
+    if errors:
+        return jsonify(errors), 422
+    if 'users' not in data:
+        return jsonify({'users': ['Missing data for required field.']}), 422
+
+    changed = update_memberships('group_id', group_id, data['users'])
+    key = 'added' if request.method == 'POST' else 'removed'
+    return jsonify({key: changed}), 200
+
+
+
+@api.route(API_URL + '/groups/query', methods=['POST'])
+def query_groups():
+    json_data = request.get_json()
+    if not json_data:
+        return jsonify({'message': "No input data provided."}), 400
+
+    # Validate and deserialize input
+    data, errors = group_query_schema.load(json_data)
+    if errors:
+        return jsonify(errors), 422
+
+    query = compile_expr(data['expr'], data.get('effective', False))
+    if data.get('count'):
+        return jsonify({'count': count_ids(query)}), 200
+    ids, cursor = paginate_ids(query, data)
+    return jsonify({'users': ids, 'next': cursor}), 200
+
+
+## Nested groups
+
+
+@api.route(API_URL + '/groups/<int:group_id>/subgroups', methods=['GET'])
+def get_subgroups(group_id):
+    error = check_exists(Group, group_id)
+    if error:
+        return error
+    return jsonify({'groups': load_subgroups(group_id)}), 200
+
+def update_subgroups(parent_id, child_ids):
+    """Add or remove (by request method) subgroups of a group.
+
+    Returns the sorted ids of the subgroups that changed.  Raises
+    ValidationError, after rolling back, if that would create a cycle.
+    """
+    try:
+        if request.method == 'POST':
+            changed = add_subgroups(parent_id, child_ids)
+        else:
+            changed = remove_subgroups(parent_id, child_ids)
+    except ValidationError:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    return changed
+
+@api.route(API_URL + '/groups/<int:group_id>/subgroups/<int:child_id>',
+           methods=['POST', 'DELETE'])
+@batched
+def modify_subgroup(group_id, child_id):
+    error = check_exists(Group, group_id) or check_exists(Group, child_id)
+    if error:
+        return error
+
+    try:
+        changed = update_subgroups(group_id, [child_id])
+    except ValidationError as err:
+        return jsonify({'message': err.messages[0]}), 409
+    if request.method == 'POST':
+        if changed:
+            return jsonify({'message': 'Subgroup added.'}), 201
+        return jsonify({'message': 'Subgroup exists.'}), 200
+    if changed:
+        return jsonify({'message': 'Subgroup removed.'}), 200
+    return jsonify({"message": "Subgroup could not be found."}), 404
+
+@api.route(API_URL + '/groups/<int:group_id>/subgroups',
+           methods=['POST', 'DELETE'])
+@batched
+def modify_subgroups(group_id):
+    json_data = request.get_json()
+    if not json_data:
+        return jsonify({'message': "No input data provided."}), 400
+
+    error = check_exists(Group, group_id)
+    if error:
+        return error
+
+    # Validate and deserialize input
+    data, errors = membership_schema.load(json_data)
+    if errors:
+        return jsonify(errors), 422
+    if 'groups' not in data:
+        return jsonify({'groups': ['Missing data for required field.']}), 422
+
+    try:
+        changed = update_subgroups(group_id, data['groups'])
+    except ValidationError as err:
+        return jsonify({'message': err.messages[0]}), 409
+    key = 'added' if request.method == 'POST' else 'removed'
+    return jsonify({key: changed}), 200
+
+@api.route(API_URL + '/users/<int:user_id>/effective-groups', methods=['GET'])
+def get_effective_groups(user_id):
+    args, errors = page_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    error = check_exists(User, user_id)
+    if error:
+        return error
+
+    ids, cursor = paginate_ids(effective_groups(user_id), args)
+    return jsonify({'groups': ids, 'next': cursor}), 200
+
+@api.route(API_URL + '/groups/<int:group_id>/effective-users', methods=['GET'])
+def get_effective_users(group_id):
+    args, errors = page_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    error = check_exists(Group, group_id)
+    if error:
+        return error
+
+    ids, cursor = paginate_ids(effective_users(group_id), args)
+    return jsonify({'users': ids, 'next': cursor}), 200
+
+
+## Change feed
+
+
+# Names of the `id` and `other_id` of each kind of change
+CHANGE_KEYS = {
+    'user': ('id',),
+    'group': ('id',),
+    'membership': ('user_id', 'group_id'),
+    'subgroup': ('group_id', 'child_id'),
+}
+
+
+@api.route(API_URL + '/changes', methods=['GET'])
+def get_changes():
+    """Return the changes after sequence number `since`, oldest first."""
+    args, errors = changes_schema.load(request.args)
+    if errors:
+        return jsonify(errors), 422
+    since = args.get('since', 0)
+
+    # After compaction, the oldest entry marks where the log now starts
+    oldest = (db.session.query(change_log.c.seq, change_log.c.kind)
+                        .order_by(change_log.c.seq).first())
+    if oldest is not None and oldest.kind == 'log' and since < oldest.seq:
+        return jsonify({'message': "Changes have been compacted; resync "
+                                   "in full, then follow changes since "
+                                   "{}.".format(oldest.seq),
+                        'since': oldest.seq}), 410
+
+    rows = (db.session.query(change_log)
+                      .filter(change_log.c.seq > since)
+                      .order_by(change_log.c.seq)
+                      .limit(args.get('limit', PAGE_SIZE)))
+    entries = []
+    for row in rows:
+        entry = {'seq': row.seq, 'kind': row.kind, 'op': row.op}
+        entry.update(zip(CHANGE_KEYS[row.kind], (row.id, row.other_id)))
+        entries.append(entry)
+    return jsonify({'changes': entries,
+                    'next': entries[-1]['seq'] if entries else since}), 200
+
+
+# App factory
+
+
+def is_sqlite_file(url):
+    url = make_url(url)
+    return (url.drivername.startswith('sqlite') and
+            url.database not in (None, '', ':memory:'))
+
+
+def engine_options(config, uri=None):
+    """Return the SQLAlchemy engine options for a configuration.
+
+    They are for the engine of `uri`, by default the primary database's.
+    """
+    url = make_url(uri or config['SQLALCHEMY_DATABASE_URI'])
+    if url.drivername.startswith('sqlite') and not is_sqlite_file(url):
+        return {}  # Flask-SQLAlchemy shares one in-memory connection
+    options = {'pool_size': config['GROUPER_POOL_SIZE'],
+               'max_overflow': config['GROUPER_MAX_OVERFLOW'],
+               'pool_pre_ping': config['GROUPER_POOL_PRE_PING']}
+    if is_sqlite_file(url):
+        # SQLAlchemy opens a new SQLite connection for every checkout by
+        # default; pooling them keeps their page caches and mappings warm.
+        # The pool hands each connection to one thread at a time.
+        options.update(poolclass=QueuePool,
+                       connect_args={'check_same_thread': False})
+    return options
+
+
+def tune_sqlite(engine, config):
+    """Set performance PRAGMAs on every new connection to a SQLite file."""
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # In WAL mode readers and the writer don't block each other, and
+        # NORMAL syncing (only at checkpoints) can't corrupt the database
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA cache_size=-{:d}'.format(
+                config['GROUPER_SQLITE_CACHE_KB']))
+        cursor.execute('PRAGMA mmap_size={:d}'.format(
+                config['GROUPER_SQLITE_MMAP_SIZE']))
+        cursor.close()
+
+
+def create_app(config=None):
+    """Create a grouper app, with `config` overriding the defaults.
+
+    Also creates any missing database tables.
+    """
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config))
+    app.json_encoder = TimedJSONEncoder
+
+    db.init_app(app)
+    app.register_blueprint(api)
+    size = app.config['GROUPER_CACHE_SIZE']
+    app.extensions['grouper_cache'] = SerializedCache(
+            LocalCache(size) if size else None)
+    app.extensions['grouper_metrics'] = make_metrics()
+    replicas = [create_engine(uri, **engine_options(app.config, uri))
+                for uri in app.config['GROUPER_READ_REPLICAS']]
+    for engine in replicas:
+        if is_sqlite_file(engine.url):
+            tune_sqlite(engine, app.config)
+    app.extensions['grouper_replicas'] = cycle(replicas) if replicas else None
+    window = app.config['GROUPER_BATCH_WINDOW_MS']
+    app.extensions['grouper_batcher'] = WriteBatcher(
+            app, window / 1000, app.config['GROUPER_BATCH_SIZE']
+            ) if window > 0 else None
+
+    with app.app_context():
+        if is_sqlite_file(app.config['SQLALCHEMY_DATABASE_URI']):
+            tune_sqlite(db.engine, app.config)
+        db.create_all()
+        with db.engine.connect() as conn:
+            app.extensions['grouper_group_search'] = conn.dialect.has_table(
+                    conn, 'groups_fts')
+    return app
+
+
+# Management commands
+
+
+MIGRATIONS = []
+
+
+def migration(step):
+    """Register `step` to be run, in order, by the `upgrade` command.
+
+    A step is called with a connection (inside the upgrade transaction) and an
+    inspector for it, and returns True if it changed the schema.  Steps must
+    check whether they are needed, so running `upgrade` twice is harmless.
+    """
+    MIGRATIONS.append(step)
+    return step
+
+
+@migration
+def add_membership_primary_key(conn, inspector):
+    """Rebuild user_groups with a composite primary key."""
+    pk = inspector.get_pk_constraint('user_groups')
+    if pk['constrained_columns']:
+        return False
+    conn.execute('ALTER TABLE user_groups RENAME TO user_groups_old')
+    user_groups.create(conn)
+    conn.execute('INSERT INTO user_groups (user_id, group_id) '
+                 'SELECT DISTINCT user_id, group_id FROM user_groups_old '
+                 'WHERE user_id IS NOT NULL AND group_id IS NOT NULL')
+    conn.execute('DROP TABLE user_groups_old')
+    return True
+
+
+@migration
+def add_columns(conn, inspector):
+    """Add any columns declared on the models that are missing."""
+    changed = False
+    for tbl in db.metadata.sorted_tables:
+        present = {c['name'] for c in inspector.get_columns(tbl.name)}
+        for col in tbl.columns:
+            if col.name in present:
+                continue
+            ddl = CreateColumn(col).compile(dialect=conn.dialect)
+            conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(tbl.name, ddl))
+            changed = True
+    return changed
+
+
+@migration
+def fill_group_closure(conn, inspector):
+    """Relate every group to itself in the group closure table."""
+    c = group_closure.c
+    missing = (select([Group.id, Group.id.label('self_id'), literal(1)])
+               .where(~exists().where((c.ancestor_id == Group.id) &
+                                      (c.descendant_id == Group.id))))
+    result = conn.execute(group_closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'paths'], missing))
+    return result.rowcount > 0
+
+
+@migration
+def add_group_search(conn, inspector):
+    """Create the full-text index of group names, on SQLite."""
+    return create_group_search(conn)
+
+
+@migration
+def add_indexes(conn, inspector):
+    """Create any indexes declared on the models that are missing."""
+    changed = False
+    for tbl in db.metadata.sorted_tables:
+        present = {ix['name'] for ix in inspector.get_indexes(tbl.name)}
+        for index in tbl.indexes:
+            if index.name in present:
+                continue
+            if index.unique:
+                col, = index.columns
+                dupes = conn.execute(select([col])
+                                     .group_by(col)
+                                     .having(func.count() > 1)
+                                     .limit(10)).fetchall()
+                if dupes:
+                    sys.exit('Cannot add {}: duplicate values {}'.format(
+                             index.name, ', '.join(repr(d) for d, in dupes)))
+            index.create(conn)
+            changed = True
+    return changed
+
+
+@migration
+def add_autoincrement(conn, inspector):
+    """Rebuild the users and groups tables with AUTOINCREMENT, on SQLite.
+
+    Without it, SQLite reuses the id of the last user or group after it is
+    deleted, and a client could take the new one's ETag for the old one's.
+    """
+    if conn.dialect.name != 'sqlite':
+        return False
+    changed = False
+    for tbl in (User.__table__, Group.__table__):
+        ddl = conn.execute("SELECT sql FROM sqlite_master "
+                           "WHERE type = 'table' AND name = ?",
+                           tbl.name).scalar()
+        if 'AUTOINCREMENT' in ddl.upper():
+            continue
+        # The new table brings its own indexes, triggers and (for groups)
+        # full-text index
+        for kind, name in conn.execute("SELECT type, name FROM sqlite_master "
+                                       "WHERE type IN ('index', 'trigger') "
+                                       "AND tbl_name = ? AND sql IS NOT NULL",
+                                       tbl.name).fetchall():
+            conn.execute('DROP {} {}'.format(kind.upper(), name))
+        if tbl is Group.__table__:
+            conn.execute('DROP TABLE IF EXISTS groups_fts')
+        # Keep the foreign keys of other tables pointing at the new table
+        conn.execute('PRAGMA legacy_alter_table = ON')
+        conn.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(tbl.name))
+        conn.execute('PRAGMA legacy_alter_table = OFF')
+        tbl.create(conn)
+        columns = ', '.join(c.name for c in tbl.columns)
+        conn.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {0}_old'
+                     .format(tbl.name, columns))
+        conn.execute('DROP TABLE {}_old'.format(tbl.name))
+        changed = True
+    return changed
+
+
+@migration
+def fill_counts(conn, inspector):
+    """Count the members of groups and the groups of users."""
+    return recount(conn) > 0
+
+
+class Upgrade(Command):
+    """Bring the database schema up to date, in place."""
+
+    def run(self):
+        db.create_all()
+        with db.engine.begin() as conn:
+            for step in MIGRATIONS:
+                if step(conn, inspect(conn)):
+                    print('Applied {}'.format(step.__name__))
+
+
+class Recount(Command):
+    """Recompute the member and group counts from the memberships."""
+
+    def run(self):
+        with db.engine.begin() as conn:
+            print('Fixed {} counts.'.format(recount(conn)))
+
+
+# Bulk import and export
+
+
+# Records validated and inserted per batch by the `import` command
+IMPORT_BATCH_SIZE = 50000
+# Invalid records reported before the `import` command gives up
+MAX_IMPORT_ERRORS = 20
+
+# Tables and columns of each kind of record, with its sort key first
+RECORD_KINDS = OrderedDict([
+    ('users', (User.__table__, ('id', 'name', 'email'))),
+    ('groups', (Group.__table__, ('id', 'name'))),
+    ('memberships', (user_groups, ('user_id', 'group_id'))),
+])
+
+
+def record_format(path, fmt=None):
+    """Return the format ('csv' or 'ndjson') of a file, by its extension."""
+    if fmt:
+        return fmt
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return 'csv'
+    if ext in ('.ndjson', '.jsonl'):
+        return 'ndjson'
+    sys.exit('Unknown format for {}; use --format.'.format(path))
+
+
+@contextmanager
+def open_records(path, mode):
+    """Open a CSV/NDJSON file, or stdin/stdout for '-'."""
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+    else:
+        with open(path, mode, newline='', encoding='utf-8') as f:
+            yield f
+
+
+def read_records(f, fmt):
+    """Yield (line number, record) for each record in a CSV/NDJSON file.
+
+    Empty CSV fields are left out of their records, and NDJSON lines that
+    aren't JSON objects are yielded as None.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, {k: v for k, v in record.items()
+                                    if k is not None and v != ''}
+    else:
+        for line_num, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_num, record if isinstance(record, dict) else None
+
+
+def parse_id(value):
+    """Return `value` as a valid id, or raise ValidationError."""
+    try:
+        id_ = int(value)
+    except (TypeError, ValueError):
+        raise ValidationError('Not a valid integer.')
+    validate_id(id_)
+    return id_
+
+
+def import_entities(model, batch, seen, errors):
+    """Validate and insert a batch of (line number, record) Users or Groups.
+
+    `seen` holds the names and ids from earlier batches, to catch duplicates
+    within the file.  Invalid records are appended to `errors` as (line
+    number, message) pairs, and nothing is inserted if there are any.
+    Returns the number of rows inserted.
+    """
+    columns = RECORD_KINDS[model.__tablename__][1][1:]
+    schema = list_schema(UserSchema if model is User else GroupSchema,
+                         columns)
+    data, load_errors = schema.load([record or {} for _, record in batch])
+
+    rows = {}
+    for i, (line, record) in enumerate(batch):
+        if record is None:
+            errors.append((line, 'Not a JSON object.'))
+            continue
+        if i in load_errors:
+            errors.append((line, load_errors[i]))
+            continue
+        row = {c: data[i][c] for c in columns}
+        try:
+            if 'id' in record:
+                row['id'] = parse_id(record['id'])
+        except ValidationError as err:
+            errors.append((line, {'id': err.messages}))
+            continue
+        if row['name'] in seen or row.get('id') in seen:
+            errors.append((line, 'Duplicate name or id in file.'))
+            continue
+        seen.update(row[c] for c in ('name', 'id') if c in row)
+        rows[line] = row
+
+    taken_names = existing_names(model, [r['name'] for r in rows.values()])
+    taken_ids = existing_ids(model, [r['id'] for r in rows.values()
+                                     if 'id' in r])
+    for line, row in rows.items():
+        if row['name'] in taken_names or row.get('id') in taken_ids:
+            errors.append((line, '{} exists.'.format(model.__name__)))
+    if errors:
+        return 0
+
+    # Rows with and without explicit ids need separate executemany calls
+    table = model.__table__
+    for with_id in (True, False):
+        params = [r for r in rows.values() if ('id' in r) == with_id]
+        if params:
+            db.session.execute(table.insert(), params)
+    ids = sorted(existing_names(model, [r['name'] for r in rows.values()])
+                 .values())
+    if model is Group:
+        init_closure(ids)
+    log_changes(model.__tablename__[:-1], 'create', ids)
+    return len(rows)
+
+
+def import_memberships(batch, touched, errors):
+    """Validate and insert a batch of (line number, record) memberships.
+
+    Memberships already present (in the database or earlier in the file)
+    are skipped.  `touched` is a pair of sets of the user and group ids
+    already known to exist, which are only checked once per import.
+    Invalid records are appended to `errors`, and nothing is inserted if
+    there are any.  Returns the number of rows inserted.
+    """
+    pairs = {}
+    for line, record in batch:
+        try:
+            pairs[line] = (parse_id(record['user_id']),
+                           parse_id(record['group_id']))
+        except (KeyError, TypeError, ValidationError):
+            errors.append((line, 'Not a valid (user_id, group_id) pair.'))
+
+    users, groups = touched
+    users.update(existing_ids(User, {u for u, _ in pairs.values()} - users))
+    groups.update(existing_ids(Group,
+                               {g for _, g in pairs.values()} - groups))
+    for line, (user_id, group_id) in pairs.items():
+        if user_id not in users:
+            errors.append((line, 'User {} does not exist.'.format(user_id)))
+        elif group_id not in groups:
+            errors.append((line, 'Group {} does not exist.'.format(group_id)))
+    if errors or not pairs:
+        return 0
+
+    u = bindparam('u', type_=db.Integer)
+    g = bindparam('g', type_=db.Integer)
+    missing = ~exists().where((user_groups.c.user_id == u) &
+                              (user_groups.c.group_id == g))
+    # Sorted, so that the inserts land in primary key order
+    params = [{'u': u_, 'g': g_} for u_, g_ in sorted(set(pairs.values()))]
+    # Log the new memberships first, while they're still missing
+    lock_change_log()
+    db.session.execute(change_log.insert().from_select(
+            ['kind', 'op', 'id', 'other_id'],
+            select([literal('membership'), literal('add'), u, g])
+            .where(missing)), params)
+    result = db.session.execute(user_groups.insert().from_select(
+            ['user_id', 'group_id'], select([u, g]).where(missing)), params)
+    return result.rowcount
+
+
+def reset_id_sequence(table):
+    """Move a PostgreSQL id sequence past ids that were inserted directly."""
+    if db.session.bind.dialect.name == 'postgresql':
+        db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "COALESCE(MAX(id), 1)) FROM {0}".format(table.name))
+
+
+class Import(Command):
+    """Import users, groups or memberships from a CSV or NDJSON file.
+
+    Records hold the columns written by `export` (ids of users and groups
+    are optional).  Everything is validated and inserted in one
+    transaction, so either all records are imported or none are.
+    """
+
+    option_list = (
+        Option('kind', choices=list(RECORD_KINDS)),
+        Option('path', help="file to read, or '-' for stdin"),
+        Option('--format', dest='fmt', choices=('csv', 'ndjson'),
+               help='file format (by default, from the file extension)'),
+        Option('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+               help='records validated and inserted at a time'),
+    )
+
+    def run(self, kind, path, fmt=None, batch_size=IMPORT_BATCH_SIZE):
+        fmt = record_format(path, fmt)
+        errors, seen, touched = [], set(), (set(), set())
+        count = 0
+        with open_records(path, 'r') as f:
+            records = read_records(f, fmt)
+            while len(errors) < MAX_IMPORT_ERRORS:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    break
+                if kind == 'memberships':
+                    count += import_memberships(batch, touched, errors)
+                else:
+                    model = User if kind == 'users' else Group
+                    count += import_entities(model, batch, seen, errors)
+
+        if errors:
+            db.session.rollback()
+            for line, message in sorted(errors)[:MAX_IMPORT_ERRORS]:
+                print('line {}: {}'.format(line, message), file=sys.stderr)
+            sys.exit('Nothing was imported.')
+        if kind == 'memberships':
+            # Cheaper than counting along with every inserted row
+            recount(db.session, *touched)
+            touch(*touched)
+        else:
+            reset_id_sequence(RECORD_KINDS[kind][0])
+        db.session.commit()
+        print('Imported {} {}.'.format(count, kind))
+
+
+class Export(Command):
+    """Export users, groups or memberships to a CSV or NDJSON file."""
+
+    option_list = (
+        Option('kind', choices=list(RECORD_KINDS)),
+        Option('path', nargs='?', default='-',
+               help="file to write, or '-' for stdout (the default)"),
+        Option('--format', dest='fmt', choices=('csv', 'ndjson'),
+               help='file format (by default, from the file extension, or '
+                    'ndjson for stdout)'),
+    )
+
+    def run(self, kind, path='-', fmt=None):
+        fmt = record_format(path, fmt or ('ndjson' if path == '-' else None))
+        table, columns = RECORD_KINDS[kind]
+        query = (select([table.c[c] for c in columns])
+                 .order_by(*[table.c[c] for c in columns[:2]])
+                 .execution_options(stream_results=True))
+        result = db.session.execute(query)
+        with open_records(path, 'w') as f:
+            if fmt == 'csv':
+                writer = csv.writer(f)
+                writer.writerow(columns)
+            while True:
+                rows = result.fetchmany(CHUNK_SIZE * 20)
+                if not rows:
+                    break
+                if fmt == 'csv':
+                    writer.writerows(rows)
+                else:
+                    f.writelines(json.dumps(dict(zip(columns, row)),
+                                            separators=(',', ':')) + '\n'
+                                 for row in rows)
+
+
+class CompactChanges(Command):
+    """Drop old entries from the change log.
+
+    Consumers that are behind the remaining entries get a 410 response from
+    /changes, and must resync in full.
+    """
+
+    option_list = (
+        Option('--keep', type=int,
+               help='number of most recent entries to keep'),
+        Option('--days', type=float,
+               help='drop entries older than this many days'),
+    )
+
+    def run(self, keep=None, days=None):
+        if keep is None and days is None:
+            sys.exit('Give --keep and/or --days.')
+        seq = change_log.c.seq
+        cutoffs = []
+        if keep is not None:
+            newest = db.session.query(func.max(seq)).scalar() or 0
+            cutoffs.append(newest - max(keep, 0))
+        if days is not None:
+            before = datetime.utcnow() - timedelta(days=days)
+            cutoffs.append(db.session.query(func.max(seq))
+                                     .filter(change_log.c.at < before)
+                                     .scalar() or 0)
+
+        # Turn the newest dropped entry into a marker, so /changes can tell
+        # consumers that fell behind it apart from ones that are up to date
+        marker = (db.session.query(seq, change_log.c.kind)
+                            .filter(seq <= max(cutoffs))
+                            .order_by(seq.desc()).first())
+        if marker is None or marker.kind == 'log':
+            print('Nothing to compact.')
+            return
+        result = db.session.execute(change_log.delete()
+                                              .where(seq < marker.seq))
+        db.session.execute(change_log.update().where(seq == marker.seq)
+                                     .values(kind='log', op='compact',
+                                             id=None, other_id=None))
+        db.session.commit()
+        print('Dropped {} changes.'.format(result.rowcount + 1))
+
+
+# Membership snapshots
+
+
+def membership_rows():
+    """Yield every (user_id, group_id) membership, in primary key order."""
+    result = db.session.execute(
+            select([user_groups.c.user_id, user_groups.c.group_id])
+            .order_by(user_groups.c.user_id, user_groups.c.group_id)
+            .execution_options(stream_results=True))
+    rows = result.fetchmany(CHUNK_SIZE * 20)
+    while rows:
+        yield from rows
+        rows = result.fetchmany(CHUNK_SIZE * 20)
+
+
+class Snapshot(Command):
+    """Write the memberships to a snapshot file for `grouper_snapshot`.
+
+    The snapshot records the change log position it was taken at; it holds
+    every change up to there, and maybe some later ones.
+    """
+
+    option_list = (
+        Option('path', help='snapshot file to write'),
+        Option('--interval', type=float,
+               help='keep running, writing a new snapshot this many seconds '
+                    'after the last one if anything changed'),
+    )
+
+    def run(self, path, interval=None):
+        written = None
+        while True:
+            seq = db.session.query(func.max(change_log.c.seq)).scalar() or 0
+            if seq != written:
+                count = write_snapshot(path, membership_rows(), seq,
+                                       int(time.time()))
+                print('Wrote {} memberships (up to change {}) to {}.'.format(
+                      count, seq, path), flush=True)
+                written = seq
+            db.session.commit()
+            if interval is None:
+                return
+            time.sleep(interval)
+
+
+manager = Manager(create_app)
+manager.add_command('upgrade', Upgrade())
+manager.add_command('recount', Recount())
+manager.add_command('import', Import())
+manager.add_command('export', Export())
+manager.add_command('compact-changes', CompactChanges())
+manager.add_command('snapshot', Snapshot())
 
 
 if __name__ == '__main__':
-    db.create_all()
     manager.run()
@@ -0,0 +1,174 @@
+"""
+Read-only membership snapshots, for checking memberships without a server.
+
+`python grouper.py snapshot` writes the `user_groups` relation to a compact
+binary file, which `Snapshot` maps into memory and answers membership and
+group-list queries from with binary searches, without copying or parsing
+anything.  Any number of processes can share one copy of a snapshot through
+the page cache.  This module only uses the standard library.
+
+A snapshot file holds, after a fixed header:
+
+* the sorted ids of every user in any group
+* CSR offsets: the groups of the i-th user are groups[offsets[i]:offsets[i+1]]
+* the ids of every user's groups, sorted within each user
+
+Ids are unsigned 32-bit integers if they all fit, and signed 64-bit
+otherwise; offsets are signed 64-bit.  Everything is little-endian, and each
+array starts on an 8-byte boundary.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+
+
+MAGIC = b'GRPSNAP\0'
+FORMAT_VERSION = 1
+
+# magic, format version, id size in bytes, change seq, creation time (unix
+# seconds), number of users, number of memberships
+HEADER = struct.Struct('<8sIIqqqq')
+
+
+def padding(size):
+    """Return the number of bytes that align `size` to 8 bytes."""
+    return -size % 8
+
+
+def write_snapshot(path, pairs, seq=0, created=0):
+    """Write (user_id, group_id) `pairs` to a snapshot file at `path`.
+
+    `pairs` must be sorted by user id, then group id, and may be any
+    iterable.  `seq` records the change log position the snapshot is up to
+    date with.  The file is written next to `path` and then renamed over it,
+    so readers never see a partial snapshot.  Returns the number of pairs.
+    """
+    users, offsets, groups = array('q'), array('q', [0]), array('q')
+    for user_id, group_id in pairs:
+        if not users or user_id != users[-1]:
+            if users and user_id < users[-1]:
+                raise ValueError('Pairs are not sorted by user id.')
+            if users:
+                offsets.append(len(groups))
+            users.append(user_id)
+        elif group_id <= groups[-1]:
+            raise ValueError('Pairs are not sorted by group id.')
+        groups.append(group_id)
+    if users:
+        offsets.append(len(groups))
+
+    if max(users or [0]) < 2**32 and max(groups or [0]) < 2**32:
+        users, groups = array('I', users), array('I', groups)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, users.itemsize, seq, created,
+                         len(users), len(groups))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        try:
+            f.write(header)
+            for values in (users, offsets, groups):
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                f.write(values.tobytes())
+                f.write(b'\0' * padding(len(values) * values.itemsize))
+            f.flush()
+            os.fsync(f.fileno())
+            # Temporary files are private, but snapshots are for sharing
+            os.chmod(f.name, 0o644)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+    return len(groups)
+
+
+class Snapshot(object):
+    """A membership snapshot file, mapped into memory.
+
+    Queries read straight from the mapping.  A newer snapshot written to the
+    same path doesn't change an open one: check `stale` and open it again.
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise ValueError('Snapshots can only be mapped on little-endian '
+                             'machines.')
+        self.path = path
+        with open(path, 'rb') as f:
+            self._stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._view = memoryview(self._map)
+            self._load()
+        except BaseException:
+            self.close()
+            raise
+
+    def _load(self):
+        if (len(self._view) < HEADER.size or
+                self._view[:len(MAGIC)] != MAGIC):
+            raise ValueError('Not a membership snapshot: {}'.format(self.path))
+        (_, version, id_size, self.seq, self.created, n_users,
+         n_memberships) = HEADER.unpack_from(self._view)
+        if version != FORMAT_VERSION or id_size not in (4, 8):
+            raise ValueError('Unsupported snapshot format: {}'
+                             .format(self.path))
+        id_format = 'I' if id_size == 4 else 'q'
+
+        self._arrays = []
+        start = HEADER.size
+        for fmt, size, count in ((id_format, id_size, n_users),
+                                 ('q', 8, n_users + 1),
+                                 (id_format, id_size, n_memberships)):
+            end = start + size * count
+            if end > len(self._view):
+                raise ValueError('Truncated snapshot: {}'.format(self.path))
+            self._arrays.append(self._view[start:end].cast(fmt))
+            start = end + padding(end)
+        self.users, self._offsets, self._groups = self._arrays
+
+    def __len__(self):
+        """Return the number of memberships."""
+        return len(self._groups)
+
+    def groups(self, user_id):
+        """Return the sorted ids of a user's groups, as a memoryview."""
+        i = bisect_left(self.users, user_id)
+        if i == len(self.users) or self.users[i] != user_id:
+            return self._groups[0:0]
+        return self._groups[self._offsets[i]:self._offsets[i + 1]]
+
+    def is_member(self, user_id, group_id):
+        """Return whether a user is directly in a group."""
+        groups = self.groups(user_id)
+        i = bisect_left(groups, group_id)
+        return i < len(groups) and groups[i] == group_id
+
+    @property
+    def stale(self):
+        """Whether a newer snapshot has replaced this one at its path."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_dev) != (self._stat.st_ino,
+                                              self._stat.st_dev)
+
+    def close(self):
+        """Unmap the snapshot.  Views returned by `groups` must be released."""
+        for view in getattr(self, '_arrays', []) + [getattr(self, '_view',
+                                                          None)]:
+            if view is not None:
+                view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
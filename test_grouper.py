@@ -4,9 +4,19 @@ System tests for grouper, to be run with a test runner like `pytest`.
 These tests assume a running server at the URL embedded below.
 """
 
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
 from uuid import uuid4
 import requests
+from sqlalchemy import event
+import grouper
 from grouper import API_URL
+from grouper_snapshot import Snapshot, write_snapshot
 
 
 URL_BASE = 'http://localhost:5000'
@@ -64,6 +74,201 @@ def test_add_update_delete_user():
     assert r.status_code == 404
 
 
+def test_paginate_users():
+    uids = []
+    for _ in range(3):
+        r = requests.post('/'.join((URL, 'users')),
+                          json=dict(name=random_name(), email=random_email()))
+        assert r.status_code == 201
+        uids.append(r.json()['user']['id'])
+
+    r = requests.get('/'.join((URL, 'users')),
+                     params=dict(limit=2, after=uids[0] - 1))
+    assert r.status_code == 200
+    assert [u['id'] for u in r.json()['users']] == uids[:2]
+    assert r.json()['next'] == uids[1]
+
+    r = requests.get('/'.join((URL, 'users')),
+                     params=dict(limit=2, after=r.json()['next']))
+    assert r.status_code == 200
+    assert [u['id'] for u in r.json()['users']] == uids[2:]
+    assert r.json()['next'] is None
+
+    for uid in uids:
+        r = requests.delete('/'.join((URL, 'users', str(uid))))
+        assert r.status_code == 200
+
+
+def test_page_queries_do_not_grow(tmp_path):
+    """A page costs the same number of queries whatever its size."""
+    app = grouper.create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db')})
+    client = app.test_client()
+    r = client.post(API_URL + '/groups/bulk', json={'groups': [
+            {'name': random_name('group')} for _ in range(10)]})
+    group_ids = [result['id'] for result in r.get_json()['groups']]
+    r = client.post(API_URL + '/users/bulk', json={'users': [
+            {'name': random_name(), 'email': random_email(),
+             'groups': group_ids[:i % 5]} for i in range(600)]})
+    assert r.status_code == 200
+
+    queries = []
+    with app.app_context():
+        event.listen(grouper.db.engine, 'before_cursor_execute',
+                     lambda *args: queries.append(args[2]))
+
+    def count(path):
+        del queries[:]
+        r = client.get(API_URL + path)
+        assert r.status_code == 200
+        return len(queries)
+
+    for kind in ('users', 'groups'):
+        for fast in (0, 1):
+            small = count('/{}?limit=1&fast={}'.format(kind, fast))
+            large = count('/{}?limit=500&fast={}'.format(kind, fast))
+            assert 0 < small == large, (kind, fast)
+
+
+def test_sparse_fieldsets():
+    r = requests.post('/'.join((URL, 'groups')), json=dict(name=random_name()))
+    group0 = r.json()['group']
+
+    r = requests.get('/'.join((URL, 'groups', str(group0['id']))),
+                     params=dict(fields='id,name'))
+    assert r.status_code == 200
+    assert r.json()['group'] == dict(id=group0['id'], name=group0['name'])
+
+    r = requests.get('/'.join((URL, 'groups')),
+                     params=dict(fields='name', after=group0['id'] - 1))
+    assert r.status_code == 200
+    assert r.json()['groups'][0] == dict(name=group0['name'])
+
+    r = requests.get('/'.join((URL, 'users')), params=dict(fields='id,what'))
+    assert r.status_code == 422
+
+    r = requests.delete('/'.join((URL, 'groups', str(group0['id']))))
+    assert r.status_code == 200
+
+
+def test_stream_users():
+    r = requests.post('/'.join((URL, 'users')),
+                      json=dict(name=random_name(), email=random_email()))
+    user0 = r.json()['user']
+
+    r = requests.get('/'.join((URL, 'users')), params=dict(stream=1))
+    assert r.status_code == 200
+    assert user0 in r.json()['users']
+
+    r = requests.get('/'.join((URL, 'users')),
+                     headers={'Accept': 'application/x-ndjson'})
+    assert r.status_code == 200
+    assert r.headers['Content-Type'] == 'application/x-ndjson'
+    users = [json.loads(line) for line in r.text.splitlines()]
+    assert user0 in users
+
+    r = requests.delete('/'.join((URL, 'users', str(user0['id']))))
+    assert r.status_code == 200
+
+
+def test_response_encodings():
+    r = requests.post('/'.join((URL, 'users')),
+                      json=dict(name=random_name(), email=random_email()))
+    user0 = r.json()['user']
+
+    # Streams are compressed whatever their size; requests decompresses
+    # gzip bodies transparently
+    r = requests.get('/'.join((URL, 'users')), params=dict(stream=1),
+                     headers={'Accept-Encoding': 'gzip'})
+    assert r.status_code == 200
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in r.headers['Vary']
+    assert user0 in r.json()['users']
+
+    r = requests.get('/'.join((URL, 'users')),
+                     headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in r.headers
+    assert r.headers['Content-Type'] == 'application/json'
+
+    if grouper.msgpack is not None:
+        headers = {'Accept': 'application/msgpack'}
+        r = requests.get('/'.join((URL, 'users', str(user0['id']))),
+                         headers=headers)
+        assert r.headers['Content-Type'] == 'application/msgpack'
+        assert grouper.msgpack.unpackb(r.content) == {'user': user0}
+        r = requests.get('/'.join((URL, 'users', str(user0['id']))),
+                         headers=dict(headers, **{'If-None-Match':
+                                                  r.headers['ETag']}))
+        assert r.status_code == 304
+
+        r = requests.get('/'.join((URL, 'users')), params=dict(stream=1),
+                         headers=headers)
+        unpacker = grouper.msgpack.Unpacker()
+        unpacker.feed(r.content)
+        assert user0 in list(unpacker)
+
+    r = requests.delete('/'.join((URL, 'users', str(user0['id']))))
+    assert r.status_code == 200
+
+
+def test_search():
+    prefix = random_name('search')
+    email = random_email()
+    uids = []
+    for name in (prefix + 'a', prefix + 'b', random_name()):
+        r = requests.post('/'.join((URL, 'users')),
+                          json=dict(name=name, email=email))
+        uids.append(r.json()['user']['id'])
+
+    r = requests.get('/'.join((URL, 'users')),
+                     params=dict(name_prefix=prefix, limit=1))
+    assert r.status_code == 200
+    assert [u['id'] for u in r.json()['users']] == uids[:1]
+    r = requests.get('/'.join((URL, 'users')),
+                     params=dict(name_prefix=prefix, after=r.json()['next']))
+    assert [u['id'] for u in r.json()['users']] == uids[1:2]
+    assert r.json()['next'] is None
+
+    r = requests.get('/'.join((URL, 'users')), params=dict(email=email))
+    assert [u['id'] for u in r.json()['users']] == uids
+
+    word = uuid4().hex
+    r = requests.post('/'.join((URL, 'groups')),
+                      json=dict(name='Search {}-team'.format(word)))
+    gid = r.json()['group']['id']
+    r = requests.get('/'.join((URL, 'groups')),
+                     params=dict(q='team ' + word[:8].upper()))
+    assert [g['id'] for g in r.json()['groups']] == [gid]
+
+    r = requests.get('/'.join((URL, 'users')), params=dict(name_prefix=''))
+    assert r.status_code == 422
+
+    for uid in uids:
+        requests.delete('/'.join((URL, 'users', str(uid))))
+    requests.delete('/'.join((URL, 'groups', str(gid))))
+
+
+def test_search_without_index(tmp_path):
+    """Without the full-text index, q still matches the starts of words."""
+    app = grouper.create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db')})
+    app.extensions['grouper_group_search'] = False
+    client = app.test_client()
+    word = uuid4().hex
+    gid = client.post(API_URL + '/groups', json={
+            'name': 'Search {}-team'.format(word)}).get_json()['group']['id']
+    client.post(API_URL + '/groups', json={'name': 'Steam 100%'})
+
+    def search(q):
+        r = client.get(API_URL + '/groups', query_string={'q': q})
+        return [g['id'] for g in r.get_json()['groups']]
+
+    assert search('team ' + word[:8].upper()) == [gid]
+    assert search('eam') == []
+    assert search(word[2:10]) == []
+    assert search('0%') == []
+
+
 def test_get_groups():
     r = requests.get('/'.join((URL, 'groups')))
     assert r.status_code == 200
@@ -105,6 +310,30 @@ def test_add_update_delete_group():
     assert r.status_code == 404
 
 
+def test_background_delete():
+    r = requests.post('/'.join((URL, 'groups')), json=dict(name=random_name()))
+    gid = str(r.json()['group']['id'])
+    r = requests.post('/'.join((URL, 'users')),
+                      json=dict(name=random_name(), email=random_email(),
+                                groups=[int(gid)]))
+    uid = str(r.json()['user']['id'])
+
+    r = requests.delete('/'.join((URL, 'groups', gid)),
+                        params=dict(background=1))
+    assert r.status_code == 202
+    for _ in range(50):
+        r = requests.get('/'.join((URL, 'groups', gid)))
+        if r.status_code == 404:
+            break
+        time.sleep(0.1)
+    assert r.status_code == 404
+
+    r = requests.get('/'.join((URL, 'users', uid)))
+    assert r.json()['user']['groups'] == []
+    r = requests.delete('/'.join((URL, 'users', uid)))
+    assert r.status_code == 200
+
+
 def test_add_and_delete_users_with_groups():
 
     # Create groups
@@ -182,6 +411,54 @@ def test_add_and_delete_users_with_groups():
     assert r.status_code == 200
 
 
+def test_bulk_add_users_and_groups():
+    groups = [dict(name=random_name()) for _ in range(2)]
+    r = requests.post('/'.join((URL, 'groups', 'bulk')),
+                      json=dict(groups=groups))
+    assert r.status_code == 200
+    results = r.json()['groups']
+    assert [g['status'] for g in results] == [201, 201]
+    gids = [g['id'] for g in results]
+
+    users = [dict(name=random_name(), email=random_email(), groups=gids),
+             dict(name=random_name(), email=random_email()),
+             dict(name=random_name(), email='what'),
+             dict(name=random_name(), email=random_email(),
+                  groups=[9999999999999999])]
+    r = requests.post('/'.join((URL, 'users', 'bulk')),
+                      json=dict(users=users))
+    assert r.status_code == 200
+    results = r.json()['users']
+    assert [u['status'] for u in results] == [201, 201, 422, 422]
+    uids = [u['id'] for u in results[:2]]
+
+    r = requests.get('/'.join((URL, 'users', str(uids[0]))))
+    assert r.status_code == 200
+    assert r.json()['user']['groups'] == gids
+
+    # existing names conflict, unless upserting
+    users[0]['email'] = random_email()
+    r = requests.post('/'.join((URL, 'users', 'bulk')),
+                      json=dict(users=users[:1]))
+    assert r.json()['users'][0]['status'] == 409
+
+    users[0]['groups'] = gids[:1]
+    r = requests.post('/'.join((URL, 'users', 'bulk')),
+                      json=dict(users=users[:1], upsert=True))
+    assert r.json()['users'][0] == dict(status=200, id=uids[0])
+
+    r = requests.get('/'.join((URL, 'users', str(uids[0]))))
+    assert r.json()['user']['email'] == users[0]['email']
+    assert r.json()['user']['groups'] == gids[:1]
+
+    for uid in uids:
+        r = requests.delete('/'.join((URL, 'users', str(uid))))
+        assert r.status_code == 200
+    for gid in gids:
+        r = requests.delete('/'.join((URL, 'groups', str(gid))))
+        assert r.status_code == 200
+
+
 def test_modify_user_groups():
 
     # setup
@@ -238,6 +515,723 @@ def test_modify_user_groups():
     assert r.status_code == 200
 
 
+def test_add_remove_memberships():
+
+    # setup
+    r = requests.post('/'.join((URL, 'groups')), json=dict(name=random_name()))
+    assert r.status_code == 201
+    group0_id = str(r.json()['group']['id'])
+
+    uids = []
+    for _ in range(3):
+        r = requests.post('/'.join((URL, 'users')),
+                          json=dict(name=random_name(), email=random_email()))
+        assert r.status_code == 201
+        uids.append(r.json()['user']['id'])
+
+    # single memberships, from either side
+    r = requests.post('/'.join((URL, 'groups', group0_id, 'users',
+                                str(uids[0]))))
+    assert r.status_code == 201
+
+    r = requests.post('/'.join((URL, 'users', str(uids[0]), 'groups',
+                                group0_id)))
+    assert r.status_code == 200
+
+    r = requests.post('/'.join((URL, 'users', str(uids[1]), 'groups',
+                                group0_id)))
+    assert r.status_code == 201
+
+    r = requests.get('/'.join((URL, 'groups', group0_id)))
+    assert r.json()['group']['users'] == uids[:2]
+
+    r = requests.delete('/'.join((URL, 'groups', group0_id, 'users',
+                                  str(uids[0]))))
+    assert r.status_code == 200
+
+    r = requests.delete('/'.join((URL, 'users', str(uids[0]), 'groups',
+                                  group0_id)))
+    assert r.status_code == 404
+
+    # batches
+    r = requests.post('/'.join((URL, 'groups', group0_id, 'users')),
+                      json=dict(users=uids))
+    assert r.status_code == 200
+    assert r.json()['added'] == [uids[0], uids[2]]
+
+    r = requests.delete('/'.join((URL, 'groups', group0_id, 'users')),
+                        json=dict(users=uids[1:]))
+    assert r.status_code == 200
+    assert r.json()['removed'] == uids[1:]
+
+    r = requests.get('/'.join((URL, 'users', str(uids[0]))))
+    assert r.json()['user']['groups'] == [int(group0_id)]
+
+    r = requests.post('/'.join((URL, 'groups', group0_id, 'users')),
+                      json=dict(users=[9999999999999999]))
+    assert r.status_code == 422
+
+    r = requests.post('/'.join((URL, 'groups', '9999999', 'users',
+                                str(uids[0]))))
+    assert r.status_code == 404
+
+    # cleanup
+    for uid in uids:
+        r = requests.delete('/'.join((URL, 'users', str(uid))))
+        assert r.status_code == 200
+    r = requests.delete('/'.join((URL, 'groups', group0_id)))
+    assert r.status_code == 200
+
+
+def test_membership_counts():
+    r = requests.post('/'.join((URL, 'groups')), json=dict(name=random_name()))
+    group0_id = str(r.json()['group']['id'])
+    r = requests.post('/'.join((URL, 'groups')), json=dict(name=random_name()))
+    group1_id = r.json()['group']['id']
+
+    uids = []
+    for groups in ([int(group0_id)], [int(group0_id), group1_id], []):
+        r = requests.post('/'.join((URL, 'users')),
+                          json=dict(name=random_name(), email=random_email(),
+                                    groups=groups))
+        uids.append(r.json()['user']['id'])
+
+    def member_count():
+        r = requests.get('/'.join((URL, 'groups', group0_id)),
+                         params=dict(fields='count'))
+        assert r.status_code == 200
+        return r.json()['group']['member_count']
+
+    assert member_count() == 2
+    requests.post('/'.join((URL, 'groups', group0_id, 'users')),
+                  json=dict(users=uids))
+    assert member_count() == 3
+    requests.delete('/'.join((URL, 'users', str(uids[0]))))
+    assert member_count() == 2
+
+    r = requests.get('/'.join((URL, 'users')),
+                     params=dict(fields='id,group_count', after=uids[1] - 1))
+    assert r.json()['users'][:2] == [dict(id=uids[1], group_count=2),
+                                     dict(id=uids[2], group_count=1)]
+
+    # counts are left out unless asked for
+    r = requests.get('/'.join((URL, 'groups', group0_id)))
+    assert 'member_count' not in r.json()['group']
+
+    for uid in uids[1:]:
+        requests.delete('/'.join((URL, 'users', str(uid))))
+    requests.delete('/'.join((URL, 'groups', group0_id)))
+    requests.delete('/'.join((URL, 'groups', str(group1_id))))
+
+
+def test_check_memberships():
+    r = requests.post('/'.join((URL, 'groups')), json=dict(name=random_name()))
+    group0_id = r.json()['group']['id']
+    r = requests.post('/'.join((URL, 'users')),
+                      json=dict(name=random_name(), email=random_email(),
+                                groups=[group0_id]))
+    user0_id = r.json()['user']['id']
+    r = requests.post('/'.join((URL, 'users')),
+                      json=dict(name=random_name(), email=random_email()))
+    user1_id = r.json()['user']['id']
+
+    r = requests.get('/'.join((URL, 'users', str(user0_id),
+                               'groups', str(group0_id))))
+    assert r.status_code == 200
+    assert r.json() == {'member': True}
+
+    r = requests.get('/'.join((URL, 'groups', str(group0_id),
+                               'users', str(user1_id))))
+    assert r.status_code == 404
+    assert r.json() == {'member': False}
+
+    r = requests.post('/'.join((URL, 'memberships', 'check')),
+                      json=dict(pairs=[[user0_id, group0_id],
+                                       [user1_id, group0_id],
+                                       [user0_id, 9999999]]))
+    assert r.status_code == 200
+    assert r.json()['members'] == [True, False, False]
+
+    r = requests.post('/'.join((URL, 'memberships', 'check')),
+                      json=dict(pairs=[[user0_id]]))
+    assert r.status_code == 422
+
+    for uid in (user0_id, user1_id):
+        r = requests.delete('/'.join((URL, 'users', str(uid))))
+        assert r.status_code == 200
+    r = requests.delete('/'.join((URL, 'groups', str(group0_id))))
+    assert r.status_code == 200
+
+
+def test_query_groups():
+    gids = []
+    for _ in range(3):
+        r = requests.post('/'.join((URL, 'groups')),
+                          json=dict(name=random_name()))
+        gids.append(r.json()['group']['id'])
+
+    memberships = [[gids[0], gids[1]], [gids[1]], [gids[1], gids[2]]]
+    uids = []
+    for groups in memberships:
+        r = requests.post('/'.join((URL, 'users')),
+                          json=dict(name=random_name(), email=random_email(),
+                                    groups=groups))
+        uids.append(r.json()['user']['id'])
+
+    def query(**data):
+        r = requests.post('/'.join((URL, 'groups', 'query')), json=data)
+        assert r.status_code == 200
+        return r.json()
+
+    assert query(expr={'and': gids[:2]})['users'] == uids[:1]
+    assert query(expr={'or': [gids[0], gids[2]]})['users'] == [uids[0],
+                                                               uids[2]]
+    assert query(expr={'minus': [gids[1], {'or': [gids[0], gids[2]]}]},
+                 )['users'] == [uids[1]]
+    assert query(expr={'or': gids}, count=True) == {'count': 3}
+
+    r = query(expr=gids[1], limit=2)
+    assert r['users'] == uids[:2]
+    assert query(expr=gids[1], limit=2, after=r['next'])['users'] == uids[2:]
+
+    r = requests.post('/'.join((URL, 'groups', 'query')),
+                      json=dict(expr={'xor': gids}))
+    assert r.status_code == 422
+
+    # Deep nesting, of one operator and alternating ones, up to the limit
+    members = [{uid for uid, groups in zip(uids, memberships) if gid in groups}
+               for gid in gids]
+    expr = gids[0]
+    for _ in range(7):
+        expr = {'and': [gids[1], expr]}
+    assert query(expr=expr)['users'] == uids[:1]
+    expr, expected = gids[1], members[1]
+    for i in range(grouper.MAX_QUERY_DEPTH):
+        op, gid = [('and', 1), ('minus', 2), ('or', 2)][i % 3]
+        expr = {op: [expr, gids[gid]]}
+        expected = {'and': expected & members[gid],
+                    'minus': expected - members[gid],
+                    'or': expected | members[gid]}[op]
+    assert query(expr=expr)['users'] == sorted(expected)
+    assert query(expr=expr, effective=True)['users'] == sorted(expected)
+    r = requests.post('/'.join((URL, 'groups', 'query')),
+                      json=dict(expr={'or': [expr, gids[0]]}))
+    assert r.status_code == 422
+
+    for uid in uids:
+        r = requests.delete('/'.join((URL, 'users', str(uid))))
+        assert r.status_code == 200
+    for gid in gids:
+        r = requests.delete('/'.join((URL, 'groups', str(gid))))
+        assert r.status_code == 200
+
+
+def test_nested_groups():
+    gids = []
+    for _ in range(3):
+        r = requests.post('/'.join((URL, 'groups')),
+                          json=dict(name=random_name()))
+        assert r.status_code == 201
+        gids.append(r.json()['group']['id'])
+    r = requests.post('/'.join((URL, 'users')),
+                      json=dict(name=random_name(), email=random_email(),
+                                groups=[gids[2]]))
+    user0_id = str(r.json()['user']['id'])
+
+    # gids[0] contains gids[1], which contains gids[2]
+    r = requests.post('/'.join((URL, 'groups', str(gids[0]), 'subgroups')),
+                      json=dict(groups=[gids[1]]))
+    assert r.status_code == 200
+    assert r.json()['added'] == [gids[1]]
+
+    r = requests.post('/'.join((URL, 'groups', str(gids[1]), 'subgroups',
+                                str(gids[2]))))
+    assert r.status_code == 201
+
+    r = requests.get('/'.join((URL, 'groups', str(gids[0]), 'subgroups')))
+    assert r.json()['groups'] == [gids[1]]
+
+    # no cycles
+    r = requests.post('/'.join((URL, 'groups', str(gids[2]), 'subgroups',
+                                str(gids[0]))))
+    assert r.status_code == 409
+
+    r = requests.get('/'.join((URL, 'users', user0_id, 'effective-groups')))
+    assert r.status_code == 200
+    assert r.json()['groups'] == gids
+
+    r = requests.get('/'.join((URL, 'groups', str(gids[0]),
+                               'effective-users')))
+    assert r.status_code == 200
+    assert r.json()['users'] == [int(user0_id)]
+
+    r = requests.get('/'.join((URL, 'users', user0_id, 'groups',
+                               str(gids[0]))), params=dict(effective=1))
+    assert r.json() == {'member': True}
+    r = requests.get('/'.join((URL, 'users', user0_id, 'groups',
+                               str(gids[0]))), params=dict(effective='yes'))
+    assert r.status_code == 422
+
+    r = requests.delete('/'.join((URL, 'groups', str(gids[1]), 'subgroups',
+                                  str(gids[2]))))
+    assert r.status_code == 200
+
+    r = requests.get('/'.join((URL, 'users', user0_id, 'effective-groups')))
+    assert r.json()['groups'] == [gids[2]]
+
+    # cleanup
+    r = requests.delete('/'.join((URL, 'users', user0_id)))
+    assert r.status_code == 200
+    for gid in gids:
+        r = requests.delete('/'.join((URL, 'groups', str(gid))))
+        assert r.status_code == 200
+
+
+def test_conditional_get():
+    r = requests.post('/'.join((URL, 'groups')), json=dict(name=random_name()))
+    group0_id = str(r.json()['group']['id'])
+    r = requests.post('/'.join((URL, 'users')),
+                      json=dict(name=random_name(), email=random_email()))
+    user0_id = str(r.json()['user']['id'])
+
+    r = requests.get('/'.join((URL, 'users', user0_id)))
+    assert r.status_code == 200
+    user_etag = r.headers['ETag']
+    r = requests.get('/'.join((URL, 'groups', group0_id)))
+    assert r.status_code == 200
+    group_etag = r.headers['ETag']
+
+    r = requests.get('/'.join((URL, 'users', user0_id)),
+                     headers={'If-None-Match': user_etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == user_etag
+
+    # membership changes are visible from both sides
+    r = requests.post('/'.join((URL, 'groups', group0_id, 'users', user0_id)))
+    assert r.status_code == 201
+
+    r = requests.get('/'.join((URL, 'users', user0_id)),
+                     headers={'If-None-Match': user_etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != user_etag
+
+    r = requests.get('/'.join((URL, 'groups', group0_id)),
+                     headers={'If-None-Match': group_etag})
+    assert r.status_code == 200
+    assert r.json()['group']['users'] == [int(user0_id)]
+
+    r = requests.delete('/'.join((URL, 'users', user0_id)))
+    assert r.status_code == 200
+    r = requests.get('/'.join((URL, 'users', user0_id)),
+                     headers={'If-None-Match': user_etag})
+    assert r.status_code == 404
+    r = requests.delete('/'.join((URL, 'groups', group0_id)))
+    assert r.status_code == 200
+
+
+def test_deleted_ids_are_not_reused():
+    for kind in ('user', 'group'):
+        data = dict(name=random_name(kind))
+        if kind == 'user':
+            data['email'] = random_email()
+        r = requests.post('/'.join((URL, kind + 's')), json=data)
+        old_id = str(r.json()[kind]['id'])
+        r = requests.get('/'.join((URL, kind + 's', old_id)))
+        etag = r.headers['ETag']
+        r = requests.delete('/'.join((URL, kind + 's', old_id)))
+        assert r.status_code == 200
+
+        data['name'] = random_name(kind)
+        r = requests.post('/'.join((URL, kind + 's')), json=data)
+        new_id = str(r.json()[kind]['id'])
+        assert int(new_id) > int(old_id)
+        r = requests.get('/'.join((URL, kind + 's', old_id)),
+                         headers={'If-None-Match': etag})
+        assert r.status_code == 404
+        r = requests.delete('/'.join((URL, kind + 's', new_id)))
+        assert r.status_code == 200
+
+
+def test_cache_stats():
+    r = requests.get('/'.join((URL, 'cache')))
+    assert r.status_code == 200
+    assert {'enabled', 'hits', 'misses'} <= set(r.json()['cache'].keys())
+
+
+def test_cache_invalidation(tmp_path):
+    """Writes invalidate the cache entries of everything they change."""
+    app = grouper.create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db'),
+            'GROUPER_CACHE_SIZE': 100})
+    client = app.test_client()
+
+    def add(kind, **data):
+        r = client.post('{}/{}s'.format(API_URL, kind), json=data)
+        assert r.status_code == 201
+        return '{}s/{}'.format(kind, r.get_json()[kind]['id'])
+
+    def get(path):
+        """GET `path`, returning whether the cache had it, and its body."""
+        hits = client.get(API_URL + '/cache').get_json()['cache']['hits']
+        body = client.get('{}/{}'.format(API_URL, path)).get_json()
+        stats = client.get(API_URL + '/cache').get_json()['cache']
+        return stats['hits'] > hits, body
+
+    def check(missed, hit):
+        for path in missed:
+            assert not get(path)[0], path
+        for path in missed + hit:
+            assert get(path)[0], path
+
+    user = add('user', name=random_name(), email=random_email())
+    other = add('user', name=random_name(), email=random_email())
+    group = add('group', name=random_name('group'))
+    user_id, group_id = int(user.split('/')[1]), int(group.split('/')[1])
+    check([user, other, group], [])
+
+    email = random_email()
+    r = client.put('{}/{}'.format(API_URL, user), json={'email': email})
+    assert r.status_code == 200
+    check([user], [other, group])
+    assert get(user)[1]['user']['email'] == email
+
+    r = client.post('{}/{}/{}'.format(API_URL, group, user))
+    assert r.status_code == 201
+    check([user, group], [other])
+    assert get(user)[1]['user']['groups'] == [group_id]
+    assert get(group)[1]['group']['users'] == [user_id]
+    r = client.delete('{}/{}/{}'.format(API_URL, user, group))
+    assert r.status_code == 200
+    check([user, group], [other])
+    assert get(group)[1]['group']['users'] == []
+
+    new = add('user', name=random_name(), email=random_email(),
+              groups=[group_id])
+    check([group], [user, other])
+    r = client.delete('{}/{}'.format(API_URL, new))
+    assert r.status_code == 200
+    check([group], [user, other])
+    assert get(group)[1]['group']['users'] == []
+
+    r = client.post('{}/{}/groups'.format(API_URL, user),
+                    json={'groups': [group_id]})
+    assert r.status_code == 200
+    check([user, group], [other])
+    r = client.delete('{}/{}'.format(API_URL, group))
+    assert r.status_code == 200
+    check([user], [other])
+    assert get(user)[1]['user']['groups'] == []
+
+    # A value read before its entry was invalidated isn't stored
+    cache = grouper.SerializedCache(grouper.LocalCache(10))
+    generation = cache.generation
+    cache.delete_many([('users', 1)])
+    cache.set(('users', 1), (1, '{}'), generation)
+    assert cache.get(('users', 1)) is None
+    cache.set(('users', 1), (2, '{}'), cache.generation)
+    assert cache.get(('users', 1)) == (2, '{}')
+
+
+def test_metrics():
+    r = requests.get('/'.join((URL, 'users?fast=0')))
+    assert r.status_code == 200
+
+    r = requests.get('/'.join((URL_BASE, 'metrics')))
+    assert r.status_code == 200
+    assert r.headers['Content-Type'].startswith('text/plain')
+    labels = '{{method="GET",route="{}/users"'.format(API_URL)
+    samples = dict(line.rsplit(' ', 1) for line in r.text.splitlines()
+                   if not line.startswith('#'))
+    for name in ('grouper_request_duration_seconds',
+                 'grouper_request_queries', 'grouper_db_duration_seconds',
+                 'grouper_serialize_duration_seconds',
+                 'grouper_json_duration_seconds'):
+        assert int(samples[name + '_count' + labels + '}']) >= 1
+        assert float(samples[name + '_sum' + labels + '}']) > 0
+    assert int(samples['grouper_requests_total' + labels +
+                       ',status="200"}']) >= 1
+
+
+def test_fast_reads_match_schema():
+    r = requests.post('/'.join((URL, 'groups')),
+                      json={'name': random_name('gr\u00fcppe "\\')})
+    group_id = r.json()['group']['id']
+    r = requests.post('/'.join((URL, 'users')),
+                      json={'name': random_name('\u00e5sa\u2603\n'),
+                            'email': random_email(), 'groups': [group_id]})
+    user_id = r.json()['user']['id']
+
+    for path, headers in [
+            ('users', {}),
+            ('users?limit=2&fields=name,groups', {}),
+            ('groups?after={}'.format(group_id - 1), {}),
+            ('users?stream=1&fields=id', {}),
+            ('groups', {'Accept': 'application/x-ndjson'}),
+            ('users/{}'.format(user_id), {}),
+            ('groups/{}?fields=users'.format(group_id), {})]:
+        sep = '&' if '?' in path else '?'
+        schema = requests.get('/'.join((URL, path + sep + 'fast=0')),
+                              headers=headers)
+        fast = requests.get('/'.join((URL, path + sep + 'fast=1')),
+                            headers=headers)
+        assert fast.status_code == schema.status_code == 200
+        assert fast.content == schema.content
+        assert fast.headers['Content-Type'] == schema.headers['Content-Type']
+        assert fast.headers.get('ETag') == schema.headers.get('ETag')
+
+    r = requests.get('/'.join((URL, 'users?fast=maybe')))
+    assert r.status_code == 422
+
+
+def test_change_feed():
+    # find the end of the feed
+    since = 0
+    while True:
+        r = requests.get('/'.join((URL, 'changes')),
+                         params={'since': since, 'limit': 1000})
+        assert r.status_code == 200
+        if not r.json()['changes']:
+            break
+        since = r.json()['next']
+
+    r = requests.post('/'.join((URL, 'groups')), json={'name': random_name()})
+    group_id = r.json()['group']['id']
+    r = requests.post('/'.join((URL, 'users')),
+                      json={'name': random_name(), 'email': random_email(),
+                            'groups': [group_id]})
+    user_id = r.json()['user']['id']
+    requests.put('/'.join((URL, 'users', str(user_id))),
+                 json={'email': random_email()})
+    requests.delete('/'.join((URL, 'groups', str(group_id))))
+
+    r = requests.get('/'.join((URL, 'changes')), params={'since': since})
+    assert r.status_code == 200
+    changes = r.json()['changes']
+    for change in changes:
+        del change['seq']
+    assert changes == [
+        {'kind': 'group', 'op': 'create', 'id': group_id},
+        {'kind': 'user', 'op': 'create', 'id': user_id},
+        {'kind': 'membership', 'op': 'add', 'user_id': user_id,
+         'group_id': group_id},
+        {'kind': 'user', 'op': 'update', 'id': user_id},
+        {'kind': 'membership', 'op': 'remove', 'user_id': user_id,
+         'group_id': group_id},
+        {'kind': 'group', 'op': 'delete', 'id': group_id},
+    ]
+
+    r = requests.get('/'.join((URL, 'changes')),
+                     params={'since': since, 'limit': 2})
+    assert len(r.json()['changes']) == 2
+    r = requests.get('/'.join((URL, 'changes')),
+                     params={'since': r.json()['next']})
+    assert len(r.json()['changes']) == 4
+
+
+def manage(*args):
+    """Run a grouper management command against the server's database."""
+    basedir = os.path.dirname(os.path.abspath(grouper.__file__))
+    return subprocess.run([sys.executable, 'grouper.py'] + list(args),
+                          cwd=basedir, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def test_import_export(tmp_path):
+    names = [random_name() for _ in range(3)]
+    users = tmp_path / 'users.csv'
+    users.write_text('name,email\n' + ''.join(
+            '{},{}\n'.format(name, random_email()) for name in names))
+    result = manage('import', 'users', str(users))
+    assert result.returncode == 0
+    assert result.stdout.strip() == 'Imported 3 users.'
+
+    exported = [json.loads(line) for line in
+                manage('export', 'users').stdout.splitlines()]
+    ids = [u['id'] for u in exported if u['name'] in names]
+    assert len(ids) == 3
+
+    r = requests.post('/'.join((URL, 'groups')), json={'name': random_name()})
+    group_id = r.json()['group']['id']
+    memberships = tmp_path / 'memberships.ndjson'
+    memberships.write_text(''.join(
+            json.dumps({'user_id': id_, 'group_id': group_id}) + '\n'
+            for id_ in ids + ids[:1]))
+    result = manage('import', 'memberships', str(memberships))
+    assert result.stdout.strip() == 'Imported 3 memberships.'
+    r = requests.get('/'.join((URL, 'groups', str(group_id))))
+    assert r.json()['group']['users'] == sorted(ids)
+
+    result = manage('export', 'memberships', '--format', 'csv')
+    assert result.stdout.splitlines()[0] == 'user_id,group_id'
+    assert '{},{}'.format(ids[0], group_id) in result.stdout.splitlines()
+
+    # invalid records abort the whole import
+    users.write_text('name,email\n{},{}\n{},not-an-email\n'.format(
+            random_name(), random_email(), random_name()))
+    result = manage('import', 'users', str(users))
+    assert result.returncode != 0
+    assert 'line 3' in result.stderr
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'memberships.snapshot')
+    pairs = [(1, 2), (1, 5), (3, 2), (2**40, 7)]
+    assert write_snapshot(path, pairs, seq=42) == 4
+    with Snapshot(path) as snapshot:
+        assert snapshot.seq == 42
+        assert len(snapshot) == 4
+        assert list(snapshot.groups(1)) == [2, 5]
+        assert list(snapshot.groups(2)) == []
+        assert snapshot.is_member(2**40, 7)
+        assert not snapshot.is_member(3, 5)
+
+        # replacing the file leaves open snapshots alone
+        assert not snapshot.stale
+        write_snapshot(path, pairs[:1])
+        assert snapshot.stale
+        assert snapshot.is_member(1, 5)
+
+    with Snapshot(path) as snapshot:
+        assert list(snapshot.groups(1)) == [2]
+        assert not snapshot.is_member(1, 5)
+
+    write_snapshot(path, [])
+    with Snapshot(path) as snapshot:
+        assert len(snapshot) == 0
+        assert not snapshot.is_member(1, 2)
+
+    try:
+        write_snapshot(path, [(3, 2), (1, 2)])
+    except ValueError:
+        pass
+    else:
+        assert False, 'unsorted pairs were accepted'
+
+
+def test_snapshot_command(tmp_path):
+    r = requests.post('/'.join((URL, 'groups')), json={'name': random_name()})
+    group_id = r.json()['group']['id']
+    r = requests.post('/'.join((URL, 'users')),
+                      json={'name': random_name(), 'email': random_email(),
+                            'groups': [group_id]})
+    user_id = r.json()['user']['id']
+
+    path = str(tmp_path / 'memberships.snapshot')
+    result = manage('snapshot', path)
+    assert result.returncode == 0
+    with Snapshot(path) as snapshot:
+        assert list(snapshot.groups(user_id)) == [group_id]
+
+
+def test_read_replicas(tmp_path):
+    """Reads go to a replica, except a client's reads of its own writes."""
+    primary = str(tmp_path / 'primary.sqlite')
+    replica = str(tmp_path / 'replica.sqlite')
+    users = API_URL + '/users'
+    app = grouper.create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + primary,
+            'GROUPER_READ_REPLICAS': ['sqlite:///' + replica]})
+    writer, reader = app.test_client(), app.test_client()
+    r = writer.post(users, json={'name': random_name(),
+                                 'email': random_email()})
+    old_id = r.get_json()['user']['id']
+    # a second SQLite file, stuck at a copy of the primary, stands in
+    # for a lagging replica
+    with sqlite3.connect(primary) as source, \
+            sqlite3.connect(replica) as target:
+        source.backup(target)
+    r = writer.post(users, json={'name': random_name(),
+                                 'email': random_email()})
+    new_id = r.get_json()['user']['id']
+
+    assert reader.get('{}/{}'.format(users, old_id)).status_code == 200
+    assert reader.get('{}/{}'.format(users, new_id)).status_code == 404
+    ids = [u['id'] for u in reader.get(users).get_json()['users']]
+    assert ids == [old_id]
+    r = reader.get('{}/{}?primary=1'.format(users, new_id))
+    assert r.status_code == 200
+
+    # the writer reads its own writes from the primary
+    assert writer.get('{}/{}'.format(users, new_id)).status_code == 200
+    ids = [u['id'] for u in writer.get(users).get_json()['users']]
+    assert ids == [old_id, new_id]
+
+
+def test_write_batching(tmp_path):
+    """Concurrent writes commit together, each with its own response."""
+    app = grouper.create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db'),
+            'GROUPER_BATCH_WINDOW_MS': 50})
+    client = app.test_client()
+    group_id = client.post(API_URL + '/groups', json={
+            'name': random_name('group')}).get_json()['group']['id']
+    commits = []
+    with app.app_context():
+        event.listen(grouper.db.engine, 'commit', commits.append)
+
+    name = random_name()
+    statuses = []
+
+    def add_user(i):
+        r = app.test_client().post(API_URL + '/users', json={
+                'name': name if i < 2 else random_name(),
+                'email': random_email(), 'groups': [group_id]})
+        statuses.append(r.status_code)
+
+    threads = [threading.Thread(target=add_user, args=(i,))
+               for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # one of the two users with the same name was rolled back on its own
+    assert sorted(statuses) == [201] * 9 + [409]
+    assert len(commits) < 9
+    r = client.get('{}/groups/{}?fields=users,member_count'.format(
+                   API_URL, group_id))
+    group = r.get_json()['group']
+    assert len(group['users']) == group['member_count'] == 9
+    # the SQL run for each write counts towards its request
+    queries = app.extensions['grouper_metrics']['grouper_request_queries']
+    counts = queries.series[('POST', API_URL + '/users')]
+    assert sum(counts[:-1]) == 10
+    assert counts[-1] >= 10 * 3
+
+
+def test_write_batching_isolates_failures(tmp_path):
+    """A failing write doesn't undo the others in its batch."""
+    app = grouper.create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'db'),
+            'GROUPER_BATCH_WINDOW_MS': 1000, 'GROUPER_BATCH_SIZE': 3})
+    client = app.test_client()
+    taken = random_name()
+    client.post(API_URL + '/users', json={
+            'name': taken, 'email': random_email()})
+    commits = []
+    with app.app_context():
+        event.listen(grouper.db.engine, 'commit', commits.append)
+
+    names = [random_name(), taken, random_name()]
+    statuses = {}
+
+    def add_user(name):
+        r = app.test_client().post(API_URL + '/users', json={
+                'name': name, 'email': random_email()})
+        statuses[name] = r.status_code
+
+    threads = [threading.Thread(target=add_user, args=(name,))
+               for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # the batch filled up, so all three writes were in it
+    assert len(commits) == 1
+    assert statuses == {names[0]: 201, taken: 409, names[2]: 201}
+    users = client.get(API_URL + '/users').get_json()['users']
+    assert sorted(u['name'] for u in users) == sorted(names)
+
+
 # Test error conditions
 
 
@@ -262,6 +1256,14 @@ def test_not_found():
     assert r.status_code == 404
 
 
+def test_bad_page_args():
+    r = requests.get('/'.join((URL, 'users')), params=dict(limit=0))
+    assert r.status_code == 422
+
+    r = requests.get('/'.join((URL, 'groups')), params=dict(after='what'))
+    assert r.status_code == 422
+
+
 def test_empty_add_user():
     r = requests.post('/'.join((URL, 'users')))
     assert r.status_code == 400
@@ -272,6 +1274,14 @@ def test_empty_add_group():
     assert r.status_code == 400
 
 
+def test_empty_bulk_add():
+    r = requests.post('/'.join((URL, 'users', 'bulk')), json=dict(users=[]))
+    assert r.status_code == 400
+
+    r = requests.post('/'.join((URL, 'groups', 'bulk')), json=[])
+    assert r.status_code == 400
+
+
 def test_bad_user_name():
     r = requests.post('/'.join((URL, 'users')),
                       json=dict(name=99, email=random_email()))
@@ -329,6 +1339,23 @@ def test_double_add_user():
     assert r.status_code == 200
 
 
+def test_rename_user_to_existing_name():
+    users = [dict(name=random_name(), email=random_email()) for _ in range(2)]
+    uids = []
+    for user in users:
+        r = requests.post('/'.join((URL, 'users')), json=user)
+        assert r.status_code == 201
+        uids.append(r.json()['user']['id'])
+
+    r = requests.put('/'.join((URL, 'users', str(uids[1]))),
+                     json=dict(name=users[0]['name']))
+    assert r.status_code == 409
+
+    for uid in uids:
+        r = requests.delete('/'.join((URL, 'users', str(uid))))
+        assert r.status_code == 200
+
+
 def test_double_add_group():
     group0 = dict(name=random_name(),
                   users=[])